@@ -0,0 +1,97 @@
+import base64
+
+import cv2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# cv2 extension and quality flag of the upload formats
+UPLOAD_FORMATS = {
+    'png': ('.png', None),
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+class RemovalError(Exception):
+    pass
+
+
+def downscale(image, max_side=None):
+    # returns the image with its longest side at most max_side and the scale that was applied
+    h, w = image.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return image, 1.0
+    scale = max_side / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+
+def apply_mask(image, result):
+    # full-resolution output from a smaller result: original pixels, upscaled alpha of the result
+    h, w = image.shape[:2]
+    alpha = result[:, :, 3] if result.ndim == 3 and result.shape[2] == 4 else result
+    if alpha.shape[:2] != (h, w):
+        alpha = cv2.resize(alpha, (w, h), interpolation=cv2.INTER_LINEAR)
+    return cv2.merge((image, alpha))
+
+
+class RemovalClient:
+    """Client for the remove_background endpoint, {"data": [image_base64, x, y]} in, {"data": png_base64} out.
+
+    One pooled session is reused for every call. Connection errors, read timeouts and 429/5xx answers
+    are retried with exponential backoff. With max_side set the image is downscaled before the upload
+    and the click is scaled with it, the endpoint then answers at the reduced size, see apply_mask.
+    JPEG and WebP uploads are much smaller than PNG, the output keeps the original pixels either way.
+    """
+
+    def __init__(self, endpoint, timeout=(3.05, 60), retries=3, backoff=0.5, max_side=None, image_format='png',
+                 quality=95, pool_size=8):
+        if image_format not in UPLOAD_FORMATS:
+            raise ValueError('unknown upload format {}, use one of {}'.format(image_format, sorted(UPLOAD_FORMATS)))
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.max_side = max_side
+        self.image_format = image_format
+        self.quality = quality
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # the endpoint has no side effects, retrying a POST is safe
+            allowed_methods=None,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def variant(self):
+        # the transport settings that change the result, part of the cache key
+        return '{}{}_{}'.format(self.image_format, self.quality if self.image_format != 'png' else '', self.max_side or 0)
+
+    def encode(self, image):
+        ext, flag = UPLOAD_FORMATS[self.image_format]
+        ok, data = cv2.imencode(ext, image, [flag, self.quality] if flag is not None else [])
+        if not ok:
+            raise RemovalError('could not encode the image as {}'.format(self.image_format))
+        return data.tobytes()
+
+    def remove_background(self, image, x, y):
+        # PNG bytes of the endpoint's result, at the upload size
+        image, scale = downscale(image, self.max_side)
+        h, w = image.shape[:2]
+        x, y = min(int(x * scale), w - 1), min(int(y * scale), h - 1)
+        payload = {'data': [base64.b64encode(self.encode(image)).decode('utf-8'), x, y]}
+        try:
+            response = self.session.post(self.endpoint, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return base64.b64decode(response.json()['data'])
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            raise RemovalError('background removal failed: {}'.format(e)) from e
+
+    def close(self):
+        self.session.close()
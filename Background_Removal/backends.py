@@ -0,0 +1,265 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from api_client import RemovalClient, RemovalError
+
+
+BACKENDS = ['remote', 'local', 'sam', 'grabcut']
+
+
+def encode_png(result_image):
+    # fast PNG compression, the result is cached and decoded right away
+    ok, data = cv2.imencode('.png', result_image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise RemovalError('could not encode the result')
+    return data.tobytes()
+
+
+def merge_alpha(image, result_mask):
+    # same output as the deployed function: the input channels plus the mask as alpha
+    alpha_channel = np.where(result_mask, 255, 0).astype(np.uint8)
+    return cv2.merge((image, alpha_channel))
+
+
+class Backend:
+    """Removes the background around the point (x, y) of an RGB image.
+
+    remove_background returns the RGBA result as PNG bytes, the same as the remote endpoint.
+    remove_background_batch takes a list of (image, x, y) and returns the results in order,
+    backends override it when a batch is cheaper than single calls.
+    variant names the backend and its settings, results of different variants are cached apart.
+    """
+    variant = ''
+
+    def remove_background(self, image, x, y):
+        raise NotImplementedError
+
+    def remove_background_batch(self, items):
+        return [self.remove_background(image, x, y) for image, x, y in items]
+
+    def close(self):
+        pass
+
+
+class RemoteBackend(Backend):
+    # the hosted endpoint, a batch runs as concurrent requests over the pooled session
+    def __init__(self, endpoint, pool_size=8, **client_kwargs):
+        self.client = RemovalClient(endpoint, pool_size=pool_size, **client_kwargs)
+        self.pool_size = pool_size
+
+    @property
+    def variant(self):
+        return self.client.variant
+
+    def remove_background(self, image, x, y):
+        return self.client.remove_background(image, x, y)
+
+    def remove_background_batch(self, items):
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(lambda item: self.client.remove_background(*item), items))
+
+    def close(self):
+        self.client.close()
+
+
+class GrabCutBackend(Backend):
+    """Model-free fallback: GrabCut seeded with the click as foreground and the border as background.
+
+    Runs on a copy downscaled to max_side, the mask is scaled back up and only the region
+    connected to the click is kept.
+    """
+
+    def __init__(self, max_side=512, iterations=5, seed_radius=0.02, workers=4):
+        self.max_side = max_side
+        self.iterations = iterations
+        self.seed_radius = seed_radius
+        self.workers = workers
+        self.variant = 'grabcut{}_{}'.format(max_side, iterations)
+
+    def mask(self, image, x, y):
+        H, W = image.shape[:2]
+        scale = min(1.0, self.max_side / max(H, W))
+        small = cv2.resize(image, (max(1, round(W * scale)), max(1, round(H * scale))), interpolation=cv2.INTER_AREA)
+        h, w = small.shape[:2]
+        cx, cy = min(int(x * scale), w - 1), min(int(y * scale), h - 1)
+
+        mask = np.full((h, w), cv2.GC_PR_BGD, dtype=np.uint8)
+        border = max(1, min(h, w) // 50)
+        # the click is foreground, everything within a quarter of the image size around it probably is
+        cv2.circle(mask, (cx, cy), max(w, h) // 4, cv2.GC_PR_FGD, -1)
+        mask[:border] = mask[-border:] = cv2.GC_BGD
+        mask[:, :border] = mask[:, -border:] = cv2.GC_BGD
+        cv2.circle(mask, (cx, cy), max(2, int(self.seed_radius * max(w, h))), cv2.GC_FGD, -1)
+        bgd, fgd = np.zeros((1, 65), np.float64), np.zeros((1, 65), np.float64)
+        # grabCut wants a 3-channel 8-bit image, the channel order does not matter to it
+        cv2.grabCut(small, mask, None, bgd, fgd, self.iterations, cv2.GC_INIT_WITH_MASK)
+        fg = np.isin(mask, (cv2.GC_FGD, cv2.GC_PR_FGD)).astype(np.uint8)
+
+        # keep the component under the click
+        _, labels = cv2.connectedComponents(fg)
+        fg = (labels == labels[cy, cx]) & (fg > 0)
+        return cv2.resize(fg.astype(np.uint8), (W, H), interpolation=cv2.INTER_LINEAR) > 0
+
+    def remove_background(self, image, x, y):
+        return encode_png(merge_alpha(image, self.mask(image, x, y)))
+
+    def remove_background_batch(self, items):
+        # OpenCV releases the GIL, threads run the images in parallel
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(lambda item: self.remove_background(*item), items))
+
+
+class SamBackend(Backend):
+    """Segment Anything on the local CPU, the same predictor call as the deployed function.
+
+    A batch runs the image encoder once over every distinct image of the batch, clicks on the
+    same image share its embedding. Needs the segment_anything package and a checkpoint.
+    """
+
+    def __init__(self, checkpoint='./sam_vit_b_01ec64.pth', model_type='vit_b', device='cpu', encoder_batch=2):
+        import torch
+        from segment_anything import SamPredictor, sam_model_registry
+
+        self.torch = torch
+        self.sam = sam_model_registry[model_type](checkpoint=checkpoint).to(device).eval()
+        self.predictor = SamPredictor(self.sam)
+        self.device = device
+        # images per encoder call, activations of the 1024 px encoder grow quickly with the batch
+        self.encoder_batch = encoder_batch
+        self.variant = 'sam_' + model_type
+
+    def embed(self, images):
+        # preprocessed like SamPredictor.set_image, encoded in one batch
+        transform = self.predictor.transform
+        inputs, sizes = [], []
+        for image in images:
+            resized = transform.apply_image(image)
+            tensor = self.torch.as_tensor(resized, device=self.device).permute(2, 0, 1).contiguous()
+            inputs.append(self.sam.preprocess(tensor[None]))
+            sizes.append((image.shape[:2], tuple(tensor.shape[-2:])))
+        with self.torch.no_grad():
+            features = self.torch.cat([
+                self.sam.image_encoder(self.torch.cat(inputs[i:i + self.encoder_batch]))
+                for i in range(0, len(inputs), self.encoder_batch)
+            ])
+        return features, sizes
+
+    def predict(self, features, original_size, input_size, x, y):
+        predictor = self.predictor
+        predictor.reset_image()
+        predictor.features = features
+        predictor.original_size = original_size
+        predictor.input_size = input_size
+        predictor.is_image_set = True
+        masks, scores, logits = predictor.predict(
+            point_coords=np.asarray([[x, y]]),
+            point_labels=np.asarray([1]),
+            multimask_output=True
+        )
+        return masks.any(axis=0)
+
+    def remove_background(self, image, x, y):
+        return self.remove_background_batch([(image, x, y)])[0]
+
+    def remove_background_batch(self, items):
+        # distinct images by content, in order of first appearance
+        keys = [hashlib.sha1(np.ascontiguousarray(image).tobytes()).digest() for image, _, _ in items]
+        unique = list(dict.fromkeys(keys))
+        images = {key: items[keys.index(key)][0] for key in unique}
+        features, sizes = self.embed([images[key] for key in unique])
+        results = []
+        for key, (image, x, y) in zip(keys, items):
+            i = unique.index(key)
+            result_mask = self.predict(features[i:i + 1], sizes[i][0], sizes[i][1], x, y)
+            results.append(encode_png(merge_alpha(image, result_mask)))
+        return results
+
+
+class BatchingBackend(Backend):
+    """Collects single calls from concurrent sessions into batches for the wrapped backend.
+
+    A worker thread takes up to max_batch waiting calls, waiting at most max_wait seconds for
+    more once the first one arrives, and runs them with one remove_background_batch call. The
+    wrapped backend is only ever used from that thread, so it needs no locking of its own.
+    """
+
+    def __init__(self, backend, max_batch=8, max_wait=0.01):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.variant = backend.variant
+        self.calls = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            batch = [self.calls.get()]
+            if batch[0] is None:
+                return
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    call = self.calls.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if call is None:
+                    self.calls.put(None)
+                    break
+                batch.append(call)
+            try:
+                results = self.backend.remove_background_batch([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            self.batches += 1
+            self.items += len(batch)
+
+    def remove_background(self, image, x, y):
+        future = Future()
+        self.calls.put(((image, x, y), future))
+        return future.result()
+
+    def remove_background_batch(self, items):
+        futures = [Future() for _ in items]
+        for item, future in zip(items, futures):
+            self.calls.put((item, future))
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.calls.put(None)
+        self.thread.join()
+        self.backend.close()
+
+
+def make_backend(name='remote', endpoint=None, sam_checkpoint='./sam_vit_b_01ec64.pth', sam_model_type='vit_b',
+                 device='cpu', **client_kwargs):
+    """Build a backend by name.
+
+    local picks SAM when segment_anything and the checkpoint are available and GrabCut otherwise.
+    """
+    if name == 'remote':
+        return RemoteBackend(endpoint, **client_kwargs)
+    if name == 'grabcut':
+        return GrabCutBackend()
+    if name == 'sam':
+        return SamBackend(sam_checkpoint, sam_model_type, device)
+    if name == 'local':
+        if os.path.exists(sam_checkpoint):
+            try:
+                return SamBackend(sam_checkpoint, sam_model_type, device)
+            except ImportError:
+                pass
+        return GrabCutBackend()
+    raise ValueError('unknown backend {}, use one of {}'.format(name, BACKENDS))
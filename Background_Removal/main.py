@@ -1,13 +1,15 @@
-import base64
 import os
 
-import requests
 import streamlit as st
 from PIL import Image
 from streamlit_image_coordinates import streamlit_image_coordinates as im_coordinates
 import cv2
 import numpy as np
 
+from api_client import RemovalError, apply_mask
+from backends import BatchingBackend, GrabCutBackend, SamBackend, make_backend
+from result_cache import ResultCache, cache_key
+
 
 st.set_page_config(layout='wide')
 
@@ -37,7 +39,51 @@ st.set_page_config(layout='wide')
 
 # set_background('./bg.jpg')
 
-api_endpoint = 'https://tvrraviteja.app.modelbit.com/v1/remove_background/latest'
+api_endpoint = os.environ.get('BG_API_ENDPOINT', 'https://tvrraviteja.app.modelbit.com/v1/remove_background/latest')
+
+# the model works at 1024 px on the longest side, larger uploads only cost transfer time
+api_max_side = int(os.environ.get('BG_MAX_SIDE', 1024))
+api_upload_format = os.environ.get('BG_UPLOAD_FORMAT', 'jpeg')
+api_timeout = float(os.environ.get('BG_TIMEOUT', 60))
+api_retries = int(os.environ.get('BG_RETRIES', 3))
+
+# remote calls the endpoint above, local runs SAM on this machine if the checkpoint is there and GrabCut otherwise,
+# sam and grabcut pick one explicitly
+backend_name = os.environ.get('BG_BACKEND', 'remote')
+sam_checkpoint = os.environ.get('BG_SAM_CHECKPOINT', './sam_vit_b_01ec64.pth')
+sam_model_type = os.environ.get('BG_SAM_MODEL_TYPE', 'vit_b')
+# clicks of concurrent sessions that arrive within batch_wait_ms run as one batch on the local backends
+max_batch = int(os.environ.get('BG_MAX_BATCH', 8))
+batch_wait_ms = float(os.environ.get('BG_BATCH_WAIT_MS', 10))
+
+# results are cached by image content and click position, the least recently used are dropped first
+cache_dir = os.environ.get('BG_CACHE_DIR', './cache')
+cache_max_mb = float(os.environ.get('BG_CACHE_MAX_MB', 512))
+cache_memory_mb = float(os.environ.get('BG_CACHE_MEMORY_MB', 64))
+
+
+@st.cache_resource
+def get_cache():
+    # one cache for all sessions of the app
+    return ResultCache(cache_dir, int(cache_max_mb * 2**20), memory_bytes=int(cache_memory_mb * 2**20))
+
+
+@st.cache_resource
+def get_backend():
+    # loaded once for all reruns and sessions, the remote backend keeps one pooled session
+    backend = make_backend(
+        backend_name, endpoint=api_endpoint, sam_checkpoint=sam_checkpoint, sam_model_type=sam_model_type,
+        timeout=(3.05, api_timeout), retries=api_retries, max_side=api_max_side, image_format=api_upload_format
+    )
+    # only the local models gain from batching, remote calls of concurrent sessions already run in parallel
+    # over the pooled session and one slow request must not hold up the clicks batched behind it
+    if isinstance(backend, (SamBackend, GrabCutBackend)):
+        return BatchingBackend(backend, max_batch, batch_wait_ms / 1000)
+    return backend
+
+
+cache = get_cache()
+backend = get_backend()
 
 
 col01, col02 = st.columns(2)
@@ -75,29 +121,32 @@ if file is not None:
         placeholder0.empty()
         placeholder2 = col02.empty()
 
-        filename = '{}_{}_{}.png'.format(file.name, value['x'], value['y'])
-
-        if os.path.exists(filename):
-            result_image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
-        else:
-            _, image_bytes = cv2.imencode('.png', np.asarray(image))
-
-            image_bytes = image_bytes.tobytes()
-
-            image_bytes_encoded_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        key = cache_key(file.getvalue(), value['x'], value['y'], backend.variant)
 
-            api_data = {"data": [image_bytes_encoded_base64, value['x'], value['y']]}
-            response = requests.post(api_endpoint, json=api_data)
+        result_image_bytes = cache.get(key)
+        if result_image_bytes is None:
+            try:
+                result_image_bytes = backend.remove_background(np.asarray(image), value['x'], value['y'])
+            except RemovalError as e:
+                col02.error(str(e))
+                st.stop()
+            except Exception as e:
+                # anything else the backend raises, e.g. a local model running out of memory
+                col02.error('background removal failed: {}: {}'.format(type(e).__name__, e))
+                st.stop()
 
-            result_image = response.json()['data']
+            # the api already returns a PNG, store it as is
+            cache.put(key, result_image_bytes)
 
-            result_image_bytes = base64.b64decode(result_image)
+        result_image = cv2.imdecode(np.frombuffer(result_image_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
 
-            result_image = cv2.imdecode(np.frombuffer(result_image_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-
-            cv2.imwrite(filename, result_image)
+        # back to the uploaded resolution when the upload was downscaled
+        result_image = apply_mask(np.asarray(image), result_image)
 
         with placeholder2:
             col02.image(result_image, use_column_width=True)
 
+        col02.caption('cache: {memory_hits} memory hits, {disk_hits} disk hits, {misses} misses, '
+                      '{entries} results, {disk_bytes} bytes on disk'.format(**cache.summary()))
+
     
\ No newline at end of file
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def cache_key(image_bytes, x, y, variant=''):
+    # the uploaded bytes decide the result, not the file name, variant tells apart results of different settings
+    key = '{}_{}_{}'.format(hashlib.sha256(image_bytes).hexdigest(), int(x), int(y))
+    return key + '_' + variant if variant else key
+
+
+class ResultCache:
+    """PNG results keyed by cache_key, a small in-memory LRU over an LRU directory on disk.
+
+    The disk store keeps at most max_bytes and max_entries, the least recently used files are
+    removed first. Recency survives restarts through the file mtimes, a hit touches the file.
+    The memory layer holds the most recently used results up to memory_bytes.
+    Safe to share between threads, e.g. across Streamlit sessions.
+    """
+
+    def __init__(self, directory='./cache', max_bytes=512 * 2**20, max_entries=None, memory_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.memory_bytes = memory_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        # key -> file size, oldest first
+        self.index = OrderedDict()
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.png'):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime_ns, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+        self.disk_size = sum(self.index.values())
+        with self.lock:
+            self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            self.memory_size -= len(self.memory.popitem(last=False)[1])
+
+    def _evict(self):
+        while self.index and (self.disk_size > self.max_bytes
+                              or self.max_entries is not None and len(self.index) > self.max_entries):
+            key, size = self.index.popitem(last=False)
+            self.disk_size -= size
+            self.stats['evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        # PNG bytes of the result, None on a miss
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                if key in self.index:
+                    self.index.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.memory[key]
+            if key not in self.index:
+                self.stats['misses'] += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                # removed behind our back
+                self.disk_size -= self.index.pop(key)
+                self.stats['misses'] += 1
+                return None
+            self.index.move_to_end(key)
+            self._remember(key, data)
+            self.stats['disk_hits'] += 1
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            path = self._path(key)
+            # write then rename, a reader never sees half a file
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self.disk_size += len(data) - self.index.pop(key, 0)
+            self.index[key] = len(data)
+            self._remember(key, data)
+            self._evict()
+
+    def summary(self):
+        with self.lock:
+            hits = self.stats['memory_hits'] + self.stats['disk_hits']
+            lookups = hits + self.stats['misses']
+            return dict(
+                self.stats,
+                hit_rate=hits / lookups if lookups else 0.0,
+                entries=len(self.index),
+                disk_bytes=self.disk_size,
+                memory_bytes=self.memory_size
+            )
@@ -0,0 +1,79 @@
+import argparse
+import base64
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+
+# offline stand-in for the remove_background endpoint, same {"data": ...} contract, no model:
+# the subject is the region flood-filled from the click
+
+
+def remove_background(image_base64_encoding, x, y, tolerance=12):
+    image_bytes = base64.b64decode(image_base64_encoding)
+
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    H, W = image.shape[:2]
+    mask = np.zeros((H + 2, W + 2), dtype=np.uint8)
+    cv2.floodFill(image.copy(), mask, (int(x), int(y)), 0, (tolerance,) * 3, (tolerance,) * 3,
+                  cv2.FLOODFILL_MASK_ONLY | cv2.FLOODFILL_FIXED_RANGE | (255 << 8))
+
+    alpha_channel = mask[1:-1, 1:-1]
+
+    result_image = cv2.merge((image, alpha_channel))
+
+    _, result_image_bytes = cv2.imencode('.png', result_image)
+
+    return base64.b64encode(result_image_bytes.tobytes()).decode('utf-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+    fail_rate = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if random.random() < self.fail_rate:
+            # lets the client retries be exercised
+            self.send_error(503)
+            return
+        try:
+            image, x, y = json.loads(body)['data']
+            result = remove_background(image, x, y)
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        time.sleep(self.latency)
+        data = json.dumps({'data': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8008, latency=0.0, fail_rate=0.0):
+    Handler.latency = latency
+    Handler.fail_rate = fail_rate
+    server = ThreadingHTTPServer((host, port), Handler)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the background removal api.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--latency', type=float, default=0.0, help='extra seconds per request')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency, args.fail_rate)
+    print('serving on http://{}:{}/ , set BG_API_ENDPOINT to use it'.format(args.host, args.port))
+    server.serve_forever()
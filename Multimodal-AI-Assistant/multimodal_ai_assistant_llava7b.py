@@ -9,6 +9,7 @@
 !pip install -q gTTS
 
 import torch
+from threading import Lock
 from transformers import BitsAndBytesConfig, pipeline
 
 quantization_config = BitsAndBytesConfig(
@@ -16,11 +17,40 @@ quantization_config = BitsAndBytesConfig(
     bnb_4bit_compute_dtype=torch.float16
 )
 
-model_id = "llava-hf/llava-1.5-7b-hf"
-
-pipe = pipeline("image-to-text",
-                model=model_id,
-                model_kwargs={"quantization_config": quantization_config})
+model_id = "llava-hf/llava-1.5-7b-hf" # "hf-internal-testing/tiny-random-LlavaForConditionalGeneration" is a small stand-in for testing on CPU
+
+class LazyModel:
+    # loads a model on first use, once even when the first requests arrive together
+
+    def __init__(self, load):
+        self.load = load
+        self.model = None
+        self.setup = []
+        self.lock = Lock()
+
+    def get(self):
+        with self.lock:
+            if self.model is None:
+                model = self.load()
+                for setup in self.setup:
+                    setup(model)
+                self.model = model
+            return self.model
+
+    def on_load(self, setup):
+        # runs setup on the model once it is loaded, right away if it already is
+        with self.lock:
+            self.setup.append(setup)
+            if self.model is not None:
+                setup(self.model)
+
+def load_llava():
+    # 4-bit loading needs a GPU, on the CPU the model is loaded unquantized
+    return pipeline("image-to-text",
+                    model=model_id,
+                    model_kwargs={"quantization_config": quantization_config} if torch.cuda.is_available() else {})
+
+llava = LazyModel(load_llava)
 
 import whisper
 import gradio as gr
@@ -31,9 +61,10 @@ from gtts import gTTS
 
 from PIL import Image
 
+# the example below loads LLaVA right away, the app loads its models on the first request
+RUN_EXAMPLE = False
+
 image_path = "img.jpg"
-image = Image.open((image_path))
-image
 
 import nltk
 nltk.download('punkt')
@@ -49,12 +80,12 @@ what is the image about?
 
 prompt = "USER: <image>\n" + prompt_instructions + "\nASSISTANT:"
 
-outputs = pipe(image, prompt=prompt, generate_kwargs={"max_new_tokens": 200})
-
-outputs
+if RUN_EXAMPLE:
+    image = Image.open((image_path))
+    outputs = llava.get()(image, prompt=prompt, generate_kwargs={"max_new_tokens": 200})
 
-for sent in sent_tokenize(outputs[0]["generated_text"]):
-    print(sent)
+    for sent in sent_tokenize(outputs[0]["generated_text"]):
+        print(sent)
 
 warnings.filterwarnings("ignore")
 
@@ -67,33 +98,112 @@ DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Using torch {torch.__version__} ({DEVICE})")
 
 import whisper
-model = whisper.load_model("medium", device=DEVICE) #you can use anything with tiny, small ,base, medium and large
-print(
-    f"Model is {'multilingual' if model.is_multilingual else 'English-only'} "
-    f"and has {sum(np.prod(p.shape) for p in model.parameters()):,} parameters."
-)
+
+WHISPER_MODEL = "medium" #you can use anything with tiny, small ,base, medium and large
+WHISPER_LANGUAGE = None # e.g. "en", None detects the language of each 30 s window
+
+def load_whisper():
+    model = whisper.load_model(WHISPER_MODEL, device=DEVICE)
+    print(
+        f"Model is {'multilingual' if model.is_multilingual else 'English-only'} "
+        f"and has {sum(np.prod(p.shape) for p in model.parameters()):,} parameters."
+    )
+    return model
+
+whisper_model = LazyModel(load_whisper)
 
 import re
 import datetime
 import os
+import json
+import atexit
+from queue import Queue, Empty
+from threading import Thread
 
 ## Logger file
 tstamp = datetime.datetime.now()
 tstamp = str(tstamp).replace(' ','_')
-logfile = f'{tstamp}_log.txt'
+logfile = f'{tstamp}_log.jsonl'
+
+LOG_MAX_BYTES = 10 * 2**20 # the log is rotated once it would grow past this size
+LOG_BACKUPS = 3
+LOG_FLUSH_S = 1.0 # records reach the file at most this long after they were logged
+
+class SessionLog:
+    # JSONL session log off the request path: write only queues the record, a background thread
+    # appends whatever arrived within flush_interval in one go and rotates the file at max_bytes,
+    # keeping path.1 (newest) to path.<backups>
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, flush_interval=LOG_FLUSH_S):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.records = Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, event, **fields):
+        self.records.put({"time": datetime.datetime.now().isoformat(), "event": event, **fields})
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.records.get(timeout=max(0.0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            closed = batch[-1] is None
+            if closed:
+                batch.pop()
+            if batch:
+                self.flush(batch)
+            if closed:
+                return
+
+    def flush(self, records):
+        # one buffered append per batch, the file is reopened only when it is rotated
+        f = None
+        try:
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            f = open(self.path, "ab")
+            for record in records:
+                line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+                if size and size + len(line) > self.max_bytes:
+                    f.close()
+                    self.rotate()
+                    f = open(self.path, "ab")
+                    size = 0
+                f.write(line)
+                size += len(line)
+        except OSError as e:
+            print(f"Could not write {len(records)} log records to {self.path}: {e}")
+        finally:
+            if f is not None:
+                f.close()
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
 
-def writehistory(text):
-    with open(logfile, 'a', encoding='utf-8') as f:
-        f.write(text)
-        f.write('\n')
-    f.close()
+    def close(self):
+        # writes what is still queued, also runs at exit
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join()
 
-def img2txt(input_text, input_image):
+session_log = SessionLog(logfile)
 
-    # load the image
-    image = Image.open(input_image)
+def make_prompt(input_text):
 
-    writehistory(f"Input text: {input_text} - Type: {type(input_text)} - Dir: {dir(input_text)}")
     if type(input_text) == tuple:
         prompt_instructions = """
         Describe the image using as much detail as possible, is it a painting, a photograph, what colors are predominant, what's happening in the image, what is the image about?
@@ -103,14 +213,297 @@ def img2txt(input_text, input_image):
         Act as an expert in imagery descriptive analysis, using as much detail as possible from the image, respond to the following prompt:
         """ + input_text
 
-    writehistory(f"prompt_instructions: {prompt_instructions}")
-    prompt = "USER: <image>\n" + prompt_instructions + "\nASSISTANT:"
+    session_log.write("prompt", input_text=input_text, prompt_instructions=prompt_instructions.strip())
+    return "USER: <image>\n" + prompt_instructions + "\nASSISTANT:"
+
+"""Image cache: follow-up questions about the same image reuse its decoded image, pixel tensor and vision features, identical questions reuse the whole reply."""
+
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from types import SimpleNamespace
+from transformers.image_processing_utils import BatchFeature
+
+IMAGE_CACHE_SIZE = 8
+RESPONSE_CACHE_SIZE = 256
+
+class LRU:
+    # small thread-safe LRU, the streaming reply runs the pipeline on its own thread
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+image_files = LRU(IMAGE_CACHE_SIZE)
+responses = LRU(RESPONSE_CACHE_SIZE)
+
+def open_image(path):
+    # the image and its content hash, decoded once per distinct file content
+    with open(path, 'rb') as f:
+        key = hashlib.sha1(f.read()).hexdigest()
+    image = image_files.get(key)
+    if image is None:
+        image = Image.open(path).convert("RGB")
+        # travels with the image through the pipeline, see CachedImageProcessor
+        image.info["content_key"] = key
+        image_files.put(key, image)
+    return key, image
+
+class CachedImageProcessor:
+    # wraps pipe.image_processor, one preprocessing per image
+
+    def __init__(self, processor, size):
+        self.processor = processor
+        self.pixels = LRU(size)
+
+    def __call__(self, images, return_tensors=None, **kwargs):
+        if not isinstance(images, Image.Image) or kwargs:
+            return self.processor(images=images, return_tensors=return_tensors, **kwargs)
+        key = images.info.get("content_key") or hashlib.sha1(images.tobytes()).hexdigest()
+        pixel_values = self.pixels.get((key, return_tensors))
+        if pixel_values is None:
+            pixel_values = self.processor(images=images, return_tensors=return_tensors)["pixel_values"]
+            self.pixels.put((key, return_tensors), pixel_values)
+        # a new BatchFeature each time, the pipeline adds the text inputs to it
+        return BatchFeature({"pixel_values": pixel_values})
+
+    def __getattr__(self, name):
+        return getattr(self.processor, name)
+
+class CachedVisionTower(torch.nn.Module):
+    # stands in for the LLaVA vision tower, the CLIP encoder only runs for images it has not seen,
+    # keyed by the pixel tensor so it works for any caller of the model
+
+    def __init__(self, tower, layer, size):
+        super().__init__()
+        self.tower = tower
+        self.layer = layer
+        self.features = LRU(size)
+
+    def forward(self, pixel_values, output_hidden_states=True, **kwargs):
+        keys = [hashlib.sha1(row.float().cpu().numpy().tobytes()).hexdigest() for row in pixel_values]
+        features = [self.features.get(key) for key in keys]
+        missing = [i for i, feature in enumerate(features) if feature is None]
+        if missing:
+            outputs = self.tower(pixel_values[missing], output_hidden_states=True)
+            for i, feature in zip(missing, outputs.hidden_states[self.layer]):
+                features[i] = feature
+                self.features.put(keys[i], feature)
+        # LLaVA only reads the hidden state of its feature layer, the others are not kept
+        hidden_states = [None] * (self.tower.config.num_hidden_layers + 1)
+        hidden_states[self.layer] = torch.stack(features)
+        return SimpleNamespace(hidden_states=hidden_states)
+
+def use_image_cache(pipe):
+    pipe.image_processor = CachedImageProcessor(pipe.image_processor, IMAGE_CACHE_SIZE)
+    pipe.model.vision_tower = CachedVisionTower(pipe.model.vision_tower, pipe.model.config.vision_feature_layer, IMAGE_CACHE_SIZE)
+
+llava.on_load(use_image_cache)
+
+def cache_stats():
+    stats = {
+        "images": (image_files.hits, image_files.misses),
+        "responses": (responses.hits, responses.misses),
+    }
+    pipe = llava.model
+    if pipe is not None:
+        stats["pixels"] = (pipe.image_processor.pixels.hits, pipe.image_processor.pixels.misses)
+        stats["features"] = (pipe.model.vision_tower.features.hits, pipe.model.vision_tower.features.misses)
+    return stats
+
+"""Serving: concurrent requests from the Gradio queue are collected into batches, one LLaVA generate call and one Whisper decode call per batch."""
+
+import shutil
+import tempfile
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread
+
+BATCHING = True
+WORKERS = 4 # requests handled at the same time, the rest wait in the Gradio queue
+QUEUE_SIZE = 64
+MAX_BATCH = 4
+MAX_BATCH_WINDOWS = 8 # 30 s windows per Whisper decode call, longer recordings are split over several calls
+BATCH_WAIT_MS = 20
+
+# one call at a time uses each model, unbatched calls of concurrent requests wait for each other
+llava_lock = Lock()
+whisper_lock = Lock()
+
+# every request writes its audio into a directory of its own, Gradio copies the files it serves into its
+# own cache, so the directories are removed once they have not changed for OUTPUT_TTL_S
+OUTPUT_DIR = tempfile.mkdtemp(prefix="assistant_")
+OUTPUT_TTL_S = 600
+
+def request_dir():
+    now = time.time()
+    for entry in os.scandir(OUTPUT_DIR):
+        try:
+            if now - entry.stat().st_mtime > OUTPUT_TTL_S:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except FileNotFoundError:
+            # removed by a concurrent request
+            pass
+    return tempfile.mkdtemp(dir=OUTPUT_DIR)
+
+class Metrics:
+    # latencies and sizes by name, the most recent samples of each are kept
+
+    def __init__(self, window=10000):
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.counts = defaultdict(int)
+        self.lock = Lock()
+        self.start = time.perf_counter()
+
+    def record(self, name, value):
+        with self.lock:
+            self.samples[name].append(value)
+            self.counts[name] += 1
+
+    def summary(self):
+        with self.lock:
+            wall = time.perf_counter() - self.start
+            summary = {"uptime_s": wall, "requests_per_s": self.counts["request_s"] / wall}
+            for name, values in self.samples.items():
+                values = np.array(values)
+                summary[name] = {
+                    "count": self.counts[name],
+                    "mean": float(values.mean()),
+                    "p50": float(np.percentile(values, 50)),
+                    "p95": float(np.percentile(values, 95)),
+                    "max": float(values.max()),
+                }
+            return summary
+
+metrics = Metrics()
+
+class MicroBatcher:
+    # collects single calls from concurrent requests into batches for fn, which takes a list of
+    # items and returns their results in order. A worker takes waiting calls until their sizes add
+    # up to max_batch and waits at most max_wait seconds for more once the first one arrives.
+    # size(item) is 1 by default, so max_batch counts calls.
+
+    def __init__(self, name, fn, max_batch=MAX_BATCH, max_wait=BATCH_WAIT_MS / 1000, workers=1, size=lambda item: 1):
+        self.name = name
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.size = size
+        self.calls = Queue()
+        self.threads = [Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+        # a call that did not fit into the last batch starts the next one
+        waiting = None
+        while True:
+            batch = [waiting or self.calls.get()]
+            waiting = None
+            total = self.size(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while total < self.max_batch:
+                try:
+                    call = self.calls.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except Empty:
+                    break
+                if total + self.size(call[0]) > self.max_batch:
+                    waiting = call
+                    break
+                batch.append(call)
+                total += self.size(call[0])
+            start = time.perf_counter()
+            for _, _, queued in batch:
+                metrics.record(f"{self.name}_wait_s", start - queued)
+            metrics.record(f"{self.name}_batch", total)
+            try:
+                results = self.fn([item for item, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            metrics.record(f"{self.name}_run_s", time.perf_counter() - start)
+
+    def submit(self, item):
+        future = Future()
+        self.calls.put((item, future, time.perf_counter()))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+def pad_left(pipe):
+    # left padding keeps the prompts of a batch aligned at the end, where generation starts
+    pipe.tokenizer.padding_side = "left"
+
+llava.on_load(pad_left)
+
+def generate_batch(requests):
+    # (image, prompt) pairs in, the decoded prompt and reply of each out, like the pipeline's generated_text
+    pipe = llava.get()
+    pixel_values = torch.cat([pipe.image_processor(images=image, return_tensors="pt")["pixel_values"] for image, _ in requests])
+    text_inputs = pipe.tokenizer([prompt for _, prompt in requests], return_tensors="pt", padding=True)
+    with llava_lock, torch.no_grad():
+        output_ids = pipe.model.generate(**text_inputs.to(pipe.device), pixel_values=pixel_values.to(pipe.device),
+                                         max_new_tokens=max_new_tokens)
+    return pipe.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+def decode_batch(recordings):
+    # the stacked 30 s windows of several recordings in, one Whisper decode call for all of them
+    model = whisper_model.get()
+    with whisper_lock:
+        results = whisper.decode(model, torch.cat(recordings), decoding_options())
+    sizes = np.cumsum([0] + [len(mels) for mels in recordings])
+    return [results[start:end] for start, end in zip(sizes[:-1], sizes[1:])]
+
+llava_batcher = MicroBatcher("generate", generate_batch)
+whisper_batcher = MicroBatcher("transcribe", decode_batch, max_batch=MAX_BATCH_WINDOWS, size=len)
 
-    outputs = pipe(image, prompt=prompt, generate_kwargs={"max_new_tokens": 200})
+def img2txt(input_text, input_image):
+
+    # load the image
+    key, image = open_image(input_image)
+
+    prompt = make_prompt(input_text)
+
+    # the same question about the same image gets the same answer
+    reply = responses.get((key, prompt, max_new_tokens))
+    if reply is not None:
+        return reply
+
+    if BATCHING:
+        # generated together with the requests of other users
+        generated_text = llava_batcher((image, prompt))
+    else:
+        pipe = llava.get()
+        with llava_lock:
+            outputs = pipe(image, prompt=prompt, generate_kwargs={"max_new_tokens": max_new_tokens})
+        generated_text = outputs[0]["generated_text"] if outputs is not None else ""
 
     # Properly extract the response text
-    if outputs is not None and len(outputs[0]["generated_text"]) > 0:
-        match = re.search(r'ASSISTANT:\s*(.*)', outputs[0]["generated_text"])
+    if len(generated_text) > 0:
+        match = re.search(r'ASSISTANT:\s*(.*)', generated_text)
         if match:
             # Extract the text after "ASSISTANT:"
             reply = match.group(1)
@@ -119,26 +512,55 @@ def img2txt(input_text, input_image):
     else:
         reply = "No response generated."
 
+    responses.put((key, prompt, max_new_tokens), reply)
     return reply
 
+OVERLAP_S = 5 # seconds shared by neighbouring 30 s windows, words cut at a window edge are whole in one of them
+
+def decoding_options():
+    # without a configured language Whisper detects it as part of the decode
+    return whisper.DecodingOptions(language=WHISPER_LANGUAGE, fp16=DEVICE == "cuda")
+
+def audio_windows(audio):
+    # 30 s windows starting every 30 - OVERLAP_S seconds, the last one padded, covering the whole recording
+    overlap = OVERLAP_S * whisper.audio.SAMPLE_RATE
+    step = whisper.audio.N_SAMPLES - overlap
+    return [whisper.pad_or_trim(audio[start:start + whisper.audio.N_SAMPLES])
+            for start in range(0, max(len(audio) - overlap, 1), step)]
+
+def merge_overlap(text, next_text, max_words=30):
+    # joins the texts of neighbouring windows, the longest run of words that ends text and starts next_text is kept once
+    words, next_words = text.split(), next_text.split()
+    normalize = lambda words: [re.sub(r"[^\w']", "", word).lower() for word in words]
+    for n in range(min(len(words), len(next_words), max_words), 0, -1):
+        if normalize(words[-n:]) == normalize(next_words[:n]):
+            return " ".join(words + next_words[n:])
+    return " ".join(words + next_words)
+
 def transcribe(audio):
 
     # Check if the audio input is None or empty
     if audio is None or audio == '':
         return ('','',None)  # Return empty strings and None audio file
 
-    # language = 'en'
-
     audio = whisper.load_audio(audio)
-    audio = whisper.pad_or_trim(audio)
 
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
+    model = whisper_model.get()
+    mels = torch.stack([whisper.log_mel_spectrogram(window, model.dims.n_mels) for window in audio_windows(audio)]).to(model.device)
 
-    _, probs = model.detect_language(mel)
+    # at most MAX_BATCH_WINDOWS windows per decode call, a long recording does not make one huge decode
+    parts = [mels[i:i + MAX_BATCH_WINDOWS] for i in range(0, len(mels), MAX_BATCH_WINDOWS)]
+    if BATCHING:
+        # decoded together with the windows of other requests
+        futures = [whisper_batcher.submit(part) for part in parts]
+        results = [result for future in futures for result in future.result()]
+    else:
+        with whisper_lock:
+            results = [result for part in parts for result in whisper.decode(model, part, decoding_options())]
 
-    options = whisper.DecodingOptions()
-    result = whisper.decode(model, mel, options)
-    result_text = result.text
+    result_text = ""
+    for result in results:
+        result_text = merge_overlap(result_text, result.text.strip())
 
     return result_text
 
@@ -166,20 +588,34 @@ import gradio as gr
 import base64
 import os
 
+def record_request(timings, **fields):
+    # stage latencies in seconds go to the metrics and, with the request's fields, to the session log
+    for name, seconds in timings.items():
+        metrics.record(name, seconds)
+    session_log.write("request", **timings, **fields)
+
 # A function to handle audio and image inputs
 def process_inputs(audio_path, image_path):
+    start = time.perf_counter()
     # Process the audio file (assuming this is handled by a function called 'transcribe')
     speech_to_text_output = transcribe(audio_path)
+    transcribed = time.perf_counter()
 
     # Handle the image input
     if image_path:
         chatgpt_output = img2txt(speech_to_text_output, image_path)
     else:
         chatgpt_output = "No image provided."
+    generated = time.perf_counter()
 
-    # Assuming 'transcribe' also returns the path to a processed audio file
-    processed_audio_path = text_to_speech(chatgpt_output, "Temp3.mp3")  # Replace with actual path if different
+    # a file per request, concurrent users do not overwrite each other's answer
+    processed_audio_path = text_to_speech(chatgpt_output, os.path.join(request_dir(), "reply.mp3"))
+    done = time.perf_counter()
 
+    record_request(
+        {"transcribe_s": transcribed - start, "generate_s": generated - transcribed, "tts_s": done - generated, "request_s": done - start},
+        image=image_path, transcript=speech_to_text_output, reply=chatgpt_output, audio=processed_audio_path
+    )
     return speech_to_text_output, chatgpt_output, processed_audio_path
 
 # Create the interface
@@ -198,6 +634,183 @@ iface = gr.Interface(
     description="Upload an image and interact via voice input and audio response."
 )
 
-# Launch the interface
-iface.launch(debug=True)
+"""Streaming mode: the reply shows up token by token and is spoken sentence by sentence while it is still being generated."""
+
+from queue import Queue, Empty
+from threading import Thread
+from transformers import TextIteratorStreamer
+
+# a streamed reply is generated on its own, not batched with other requests, so the batched
+# interface is the one served by default
+STREAMING = False
+STREAM_TIMEOUT_S = 120 # longest wait for the next piece of the reply before the request is given up
+
+def img2txt_stream(input_text, input_image):
+    # yields the reply piece by piece as LLaVA generates it
+
+    key, image = open_image(input_image)
+
+    prompt = make_prompt(input_text)
+
+    reply = responses.get((key, prompt, max_new_tokens))
+    if reply is not None:
+        yield reply
+        return
+
+    pipe = llava.get()
+
+    # skip_prompt drops the echoed "USER: ... ASSISTANT:" part, only the reply is streamed
+    streamer = TextIteratorStreamer(pipe.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT_S)
+    errors = []
+
+    def generate():
+        try:
+            with llava_lock:
+                pipe(image, prompt=prompt, generate_kwargs={"max_new_tokens": max_new_tokens, "streamer": streamer})
+        except Exception as e:
+            # handed to the consumer, end() wakes it up instead of leaving it waiting for the timeout
+            errors.append(e)
+            streamer.end()
+
+    generation = Thread(target=generate, daemon=True)
+    generation.start()
+    reply = ""
+    try:
+        for text in streamer:
+            reply += text
+            yield text
+    except Empty:
+        raise TimeoutError(f"no reply from LLaVA for {STREAM_TIMEOUT_S} s") from None
+    generation.join()
+    if errors:
+        raise errors[0]
+    responses.put((key, prompt, max_new_tokens), reply)
+
+class SpeechWorker:
+    # turns sentences into mp3 files on a background thread, in the order they were handed in
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.sentences = Queue()
+        self.files = Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        i = 0
+        while True:
+            sentence = self.sentences.get()
+            if sentence is None:
+                break
+            try:
+                self.files.put(text_to_speech(sentence, f"{self.prefix}_{i}.mp3"))
+            except Exception as e:
+                session_log.write("tts_error", sentence=sentence, error=str(e))
+            i += 1
+        self.files.put(None)
+
+    def say(self, sentence):
+        if sentence.strip():
+            self.sentences.put(sentence)
+
+    def finish(self):
+        self.sentences.put(None)
+
+    def ready(self):
+        # audio files finished so far, without waiting
+        files = []
+        while True:
+            try:
+                files.append(self.files.get_nowait())
+            except Empty:
+                return files
+
+    def rest(self):
+        # waits for the remaining audio files
+        while True:
+            path = self.files.get()
+            if path is None:
+                return
+            yield path
+
+def complete_sentences(text):
+    # sentences of text that are known to be complete and the length of text they cover,
+    # the last sentence may still grow while tokens arrive
+    sentences = sent_tokenize(text)
+    if len(sentences) < 2:
+        return [], 0
+    return sentences[:-1], text.rfind(sentences[-1])
+
+def process_inputs_streaming(audio_path, image_path):
+    start = time.perf_counter()
+    speech_to_text_output = transcribe(audio_path)
+    transcribed = time.perf_counter()
+    timings = {"transcribe_s": transcribed - start}
+    yield speech_to_text_output, "", None
+
+    output_dir = request_dir()
+    if not image_path:
+        chatgpt_output = "No image provided."
+        processed_audio_path = text_to_speech(chatgpt_output, os.path.join(output_dir, "reply.mp3"))
+        yield speech_to_text_output, chatgpt_output, processed_audio_path
+        done = time.perf_counter()
+        timings.update(tts_s=done - transcribed, request_s=done - start)
+        record_request(timings, image=image_path, transcript=speech_to_text_output, reply=chatgpt_output, audio=processed_audio_path)
+        return
+
+    speech = SpeechWorker(prefix=os.path.join(output_dir, "reply"))
+    reply, spoken, files = "", 0, []
+    for text in img2txt_stream(speech_to_text_output, image_path):
+        reply += text
+        sentences, length = complete_sentences(reply[spoken:])
+        for sentence in sentences:
+            speech.say(sentence)
+        spoken += length
+
+        # one audio chunk per update, the streaming player queues them up
+        audio = speech.ready()
+        if audio and not files:
+            timings["first_audio_s"] = time.perf_counter() - start
+        files += audio
+        yield speech_to_text_output, reply.strip(), audio[0] if audio else None
+        for path in audio[1:]:
+            yield speech_to_text_output, reply.strip(), path
+
+    generated = time.perf_counter()
+    timings["generate_s"] = generated - transcribed
+
+    speech.say(reply[spoken:])
+    speech.finish()
+    for path in speech.rest():
+        if not files:
+            timings["first_audio_s"] = time.perf_counter() - start
+        files.append(path)
+        yield speech_to_text_output, reply.strip(), path
+    done = time.perf_counter()
+    # the speech still to be made once the reply was complete
+    timings.update(tts_s=done - generated, request_s=done - start)
+    record_request(timings, image=image_path, transcript=speech_to_text_output, reply=reply.strip(), audio=files)
+
+iface_streaming = gr.Interface(
+    fn=process_inputs_streaming,
+    inputs=[
+        gr.Audio(sources=["microphone"], type="filepath"),
+        gr.Image(type="filepath")
+    ],
+    outputs=[
+        gr.Textbox(label="Speech to Text"),
+        gr.Textbox(label="AI Output"),
+        gr.Audio(streaming=True, autoplay=True)
+    ],
+    title="Multi Modal AI Assistant Using Whisper and Llava",
+    description="Upload an image and interact via voice input and audio response."
+)
+
+# Launch the interface, WORKERS requests run at once and up to QUEUE_SIZE wait for their turn
+if STREAMING:
+    iface_streaming.queue(default_concurrency_limit=WORKERS, max_size=QUEUE_SIZE).launch(debug=True)
+else:
+    iface.queue(default_concurrency_limit=WORKERS, max_size=QUEUE_SIZE).launch(debug=True)
+
+print(metrics.summary())
 
@@ -0,0 +1,194 @@
+# -- coding: utf-8 --`
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+# engine
+from stable_diffusion_engine import StableDiffusionEngine
+from stand_in_models import StandInTokenizer, make_stand_in_models
+# scheduler
+from diffusers import LMSDiscreteScheduler, PNDMScheduler
+# utils
+import numpy as np
+from openvino.runtime import get_version
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    # peak of the whole process, meaningful because every scenario runs in a process of its own
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if platform.system() == "Darwin" else peak / 2**10
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_scheduler(mode, args):
+    if mode == "txt2img":
+        return LMSDiscreteScheduler(
+            beta_start=args.beta_start,
+            beta_end=args.beta_end,
+            beta_schedule=args.beta_schedule,
+            tensor_format="np"
+        )
+    return PNDMScheduler(
+        beta_start=args.beta_start,
+        beta_end=args.beta_end,
+        beta_schedule=args.beta_schedule,
+        skip_prk_steps = True,
+        tensor_format="np"
+    )
+
+
+def make_inputs(engine, mode, seed):
+    if mode == "txt2img":
+        return None, None
+    rng = np.random.RandomState(seed)
+    h, w = engine.init_image_shape
+    init_image = rng.randint(0, 256, (h, w, 3), dtype=np.uint8)
+    if mode == "img2img":
+        return init_image, None
+    mask = np.zeros((h, w), dtype=np.uint8)
+    mask[h // 4:3 * h // 4, w // 4:3 * w // 4] = 255
+    return init_image, mask
+
+
+def run_scenario(engine, mode, steps, batch_size, args):
+    scheduler = make_scheduler(mode, args)
+    init_image, mask = make_inputs(engine, mode, args.seed)
+    prompts = [f"benchmark prompt number {i}" for i in range(batch_size)]
+
+    def call(seed):
+        return engine(
+            prompt=prompts,
+            init_image=init_image,
+            mask=mask,
+            strength=args.strength,
+            num_inference_steps=steps,
+            seeds=[seed + i for i in range(batch_size)],
+            scheduler=scheduler,
+            lean=args.lean
+        )
+
+    for i in range(args.warmup):
+        call(args.seed + i * batch_size)
+    latencies = []
+    for i in range(args.repeats):
+        start = time.perf_counter()
+        call(args.seed + (args.warmup + i) * batch_size)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "mode": mode,
+        "steps": steps,
+        "batch_size": batch_size,
+        "repeats": args.repeats,
+        "images_per_sec": batch_size * len(latencies) / sum(latencies),
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p95": float(np.percentile(latencies, 95)),
+        "latency_mean": float(np.mean(latencies)),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def run_scenario_process(mode, steps, batch_size):
+    # the same command line with --scenario, the child prints its row as the last line of its output
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    command += ["--scenario", mode, str(steps), str(batch_size), "--output", ""]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def scenario_main(args):
+    if args.model is None:
+        # offline run on tiny generated models with the same input/output names
+        model = make_stand_in_models(args.stand_in_dir, image_size=args.image_size, channels=args.channels)
+        tokenizer = StandInTokenizer()
+    else:
+        model = args.model
+        tokenizer = args.tokenizer
+    engine = StableDiffusionEngine(
+        model=model,
+        scheduler=make_scheduler("txt2img", args),
+        tokenizer=tokenizer,
+        device=args.device,
+        cache_dir=None
+    )
+    mode, steps, batch_size = args.scenario
+    print(json.dumps(run_scenario(engine, mode, int(steps), int(batch_size), args)))
+
+
+def main(args):
+    results = []
+    for mode in args.modes:
+        for steps in args.steps:
+            for batch_size in args.batch_sizes:
+                # a fresh process per scenario, ru_maxrss never goes down so a shared process
+                # would report the highest peak so far instead of the scenario's own
+                row = run_scenario_process(mode, steps, batch_size)
+                results.append(row)
+                print(
+                    f"{mode:<8} steps={steps:<4} batch={batch_size:<3} "
+                    f"{row['images_per_sec']:8.2f} img/s  p50={row['latency_p50'] * 1000:8.1f}ms  "
+                    f"p95={row['latency_p95'] * 1000:8.1f}ms  rss={row['peak_rss_mb'] or 0:.0f}MB"
+                )
+    report = {
+        "commit": git_commit(),
+        "openvino": get_version(),
+        "device": args.device,
+        "model": args.model or "stand-in",
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "scenario")},
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # models, the default generates stand-in IR models so the benchmark runs offline
+    parser.add_argument("--model", type=str, default=None, help="model name or directory, stand-in models if not set")
+    parser.add_argument("--tokenizer", type=str, default="openai/clip-vit-large-patch14", help="tokenizer, only used with --model")
+    parser.add_argument("--stand-in-dir", type=str, default="./stand_in_ir", help="where the stand-in models are written")
+    parser.add_argument("--image-size", type=int, default=128, help="image size of the stand-in models")
+    parser.add_argument("--channels", type=int, default=64, help="width of the stand-in models")
+    parser.add_argument("--device", type=str, default="CPU", help="inference device")
+    # scheduler params
+    parser.add_argument("--beta-start", type=float, default=0.00085, help="beta_start")
+    parser.add_argument("--beta-end", type=float, default=0.012, help="beta_end")
+    parser.add_argument("--beta-schedule", type=str, default="scaled_linear", help="beta_schedule")
+    # scenarios
+    parser.add_argument("--modes", nargs="+", default=["txt2img", "img2img", "inpaint"], choices=["txt2img", "img2img", "inpaint"])
+    parser.add_argument("--steps", nargs="+", type=int, default=[8, 32], help="num inference steps")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4], help="prompts per call")
+    parser.add_argument("--strength", type=float, default=0.5, help="img2img/inpaint strength")
+    parser.add_argument("--lean", action="store_true", help="use the memory-lean denoising loop")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed calls per scenario")
+    parser.add_argument("--repeats", type=int, default=5, help="timed calls per scenario")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    # output
+    parser.add_argument("--output", type=str, default="benchmark.json", help="JSON report, compare these across commits")
+    # internal, runs one scenario and prints its row
+    parser.add_argument("--scenario", nargs=3, default=None, metavar=("MODE", "STEPS", "BATCH_SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.scenario is None:
+        main(args)
+    else:
+        scenario_main(args)
@@ -5,6 +5,8 @@ import json
 import random
 # engine
 from stable_diffusion_engine import StableDiffusionEngine
+from server import GenerationServer
+from profiling import Profiler
 # scheduler
 from diffusers import LMSDiscreteScheduler, PNDMScheduler
 # utils
@@ -36,18 +38,72 @@ def main(args):
         model=args.model,
         scheduler=scheduler,
         tokenizer=args.tokenizer,
-        device=args.device
+        device=args.device,
+        text_cache_size=args.text_cache_size,
+        cache_dir=None if args.cache_dir == "" else args.cache_dir,
+        lazy=not args.eager,
+        performance_hint="THROUGHPUT" if args.workers else None,
+        profiler=Profiler(args.profile_output) if args.profile or args.profile_output else None
     )
-    image = engine(
-        prompt=args.prompt,
-        init_image=None if args.init_image is None else cv2.imread(args.init_image),
-        mask=None if args.mask is None else cv2.imread(args.mask, 0),
-        strength=args.strength,
-        num_inference_steps=args.num_inference_steps,
-        guidance_scale=args.guidance_scale,
-        eta=args.eta
-    )
-    cv2.imwrite(args.output, image)
+    if args.prompt_file is None:
+        image = engine(
+            prompt=args.prompt,
+            init_image=None if args.init_image is None else cv2.imread(args.init_image),
+            mask=None if args.mask is None else cv2.imread(args.mask, 0),
+            strength=args.strength,
+            num_inference_steps=args.num_inference_steps,
+            guidance_scale=args.guidance_scale,
+            eta=args.eta,
+            tiled=args.tiled,
+            tile_overlap=args.tile_overlap,
+            lean=args.lean
+        )
+        cv2.imwrite(args.output, image)
+    else:
+        # one image per line of the prompt file, generated in batches with consecutive seeds
+        with open(args.prompt_file, encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+        name, ext = os.path.splitext(args.output)
+        init_image = None if args.init_image is None else cv2.imread(args.init_image)
+        mask = None if args.mask is None else cv2.imread(args.mask, 0)
+        # every batch has batch_size prompts, the last one is padded with repeats of its last prompt
+        # and the padded images are dropped, a shorter batch would reshape and compile another unet
+        batches = []
+        for start in range(0, len(prompts), args.batch_size):
+            batch = prompts[start:start + args.batch_size]
+            batches.append((start, len(batch), batch + batch[-1:] * (args.batch_size - len(batch))))
+        kwargs = dict(
+            init_image=init_image,
+            mask=mask,
+            strength=args.strength,
+            num_inference_steps=args.num_inference_steps,
+            guidance_scale=args.guidance_scale,
+            eta=args.eta,
+            tiled=args.tiled,
+            tile_overlap=args.tile_overlap,
+            lean=args.lean
+        )
+        if args.workers:
+            # batches run concurrently and interleave their UNet steps on one set of weights
+            with GenerationServer(engine, workers=args.workers, max_queue=args.max_queue) as server:
+                jobs = [
+                    (start, count, server.submit(batch, seeds=[args.seed + start + i for i in range(len(batch))], **kwargs))
+                    for start, count, batch in batches
+                ]
+                results = [(start, count, job.wait()) for start, count, job in jobs]
+        else:
+            results = [
+                (start, count, engine(prompt=batch, seeds=[args.seed + start + i for i in range(len(batch))], **kwargs))
+                for start, count, batch in batches
+            ]
+        for start, count, images in results:
+            for i, image in enumerate(images[:count]):
+                cv2.imwrite(f"{name}_{start + i}{ext}", image)
+        print("text cache:", engine.text_cache.stats())
+    if args.startup_report:
+        print(engine.startup_summary())
+    if args.profile:
+        print(engine.profiler.summary())
 
 
 if __name__ == "__main__":
@@ -56,6 +112,14 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, default="bes-dev/stable-diffusion-v1-4-openvino", help="model name")
     # inference device
     parser.add_argument("--device", type=str, default="CPU", help=f"inference device [{', '.join(Core().available_devices)}]")
+    # compiled model cache
+    parser.add_argument("--cache-dir", type=str, default="./cache", help="root of the compiled model cache, empty string disables it")
+    parser.add_argument("--eager", action="store_true", help="compile all models at startup instead of on first use")
+    parser.add_argument("--startup-report", action="store_true", help="print download/read/compile time and cache hits per model")
+    parser.add_argument("--lean", action="store_true", help="float32 denoising loop on preallocated buffers bound to the unet infer request")
+    # profiling
+    parser.add_argument("--profile", action="store_true", help="print the time spent in every phase of the pipeline")
+    parser.add_argument("--profile-output", type=str, default=None, help="append per-call phase timings to a .json/.jsonl or .csv file")
     # randomizer params
     parser.add_argument("--seed", type=int, default=None, help="random seed for generating consistent images per prompt")
     # scheduler params
@@ -70,11 +134,19 @@ if __name__ == "__main__":
     parser.add_argument("--tokenizer", type=str, default="openai/clip-vit-large-patch14", help="tokenizer")
     # prompt
     parser.add_argument("--prompt", type=str, default="Street-art painting of Emilia Clarke in style of Banksy, photorealism", help="prompt")
+    # batched generation
+    parser.add_argument("--prompt-file", type=str, default=None, help="text file with one prompt per line, generated in batches")
+    parser.add_argument("--batch-size", type=int, default=4, help="number of prompts per batch when using --prompt-file")
+    parser.add_argument("--workers", type=int, default=0, help="run --prompt-file batches concurrently on this many worker threads")
+    parser.add_argument("--max-queue", type=int, default=16, help="maximum number of batches waiting for a worker")
+    parser.add_argument("--text-cache-size", type=int, default=256, help="number of prompt embeddings kept in the LRU text cache")
     # Parameter re-use:
     parser.add_argument("--params-from", type=str, required=False, help="Extract parameters from a previously generated image.")
     # img2img params
     parser.add_argument("--init-image", type=str, default=None, help="path to initial image")
     parser.add_argument("--strength", type=float, default=0.5, help="how strong the initial image should be noised [0.0, 1.0]")
+    parser.add_argument("--tiled", action="store_true", help="process init images larger than the model size at full resolution in overlapping tiles")
+    parser.add_argument("--tile-overlap", type=int, default=64, help="overlap between neighbouring tiles in pixels")
     # inpainting
     parser.add_argument("--mask", type=str, default=None, help="mask of the region to inpaint on the initial image")
     # output name
@@ -0,0 +1,95 @@
+import csv
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class CallProfile:
+    # wall time of every phase of one engine call
+    def __init__(self, call_id, **meta):
+        self.call_id = call_id
+        self.meta = meta
+        self.phases = []
+        self.total = 0.0
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name, step=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({"phase": name, "step": step, "seconds": time.perf_counter() - start})
+
+    def finish(self):
+        self.total = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {"call": self.call_id, **self.meta, "total": self.total, "phases": self.phases}
+
+
+class _NoProfile:
+    def phase(self, name, step=None):
+        return nullcontext()
+
+
+NO_PROFILE = _NoProfile()
+
+
+class Profiler:
+    """Collects per-call phase timings from StableDiffusionEngine.
+
+    sink is an optional path, calls are appended as JSON lines for .json/.jsonl
+    and as (call, phase, step, seconds) rows for .csv.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.calls = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def begin(self, **meta):
+        return CallProfile(next(self._ids), **meta)
+
+    def end(self, profile):
+        profile.finish()
+        with self._lock:
+            self.calls.append(profile)
+            if self.sink is not None:
+                self._write(profile)
+
+    def _write(self, profile):
+        if self.sink.endswith(".csv"):
+            new_file = not os.path.exists(self.sink)
+            with open(self.sink, "a", newline="") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(["call", "phase", "step", "seconds"])
+                for phase in profile.phases:
+                    writer.writerow([profile.call_id, phase["phase"], phase["step"], phase["seconds"]])
+                writer.writerow([profile.call_id, "total", None, profile.total])
+        else:
+            with open(self.sink, "a") as f:
+                f.write(json.dumps(profile.to_dict()) + "\n")
+
+    def totals(self):
+        # phase name -> [count, seconds] over all recorded calls
+        totals = defaultdict(lambda: [0, 0.0])
+        for profile in self.calls:
+            for phase in profile.phases:
+                totals[phase["phase"]][0] += 1
+                totals[phase["phase"]][1] += phase["seconds"]
+        return dict(totals)
+
+    def summary(self):
+        total = sum(profile.total for profile in self.calls)
+        lines = [f"{len(self.calls)} calls, {total:.2f}s total"]
+        lines.append(f"{'phase':<16}{'count':>7}{'total':>10}{'mean':>10}{'share':>8}")
+        for name, (count, seconds) in sorted(self.totals().items(), key=lambda item: -item[1][1]):
+            share = seconds / total if total else 0.0
+            lines.append(f"{name:<16}{count:>7}{seconds:>9.3f}s{seconds / count * 1000:>8.1f}ms{share:>8.1%}")
+        return "\n".join(lines)
@@ -0,0 +1,127 @@
+import copy
+import itertools
+import queue
+import random
+import threading
+import time
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class GenerationJob:
+    def __init__(self, job_id, kwargs):
+        self.id = job_id
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.step = 0
+        self.num_steps = kwargs.get("num_inference_steps", 32)
+        self.result = None
+        self.error = None
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def progress(self):
+        return self.step / self.num_steps if self.num_steps else 0.0
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        # queued jobs are dropped, running jobs stop after their current UNet step
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"job {self.id} did not finish in {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _on_step(self, step, num_steps):
+        self.step = step
+        self.num_steps = num_steps
+        if self._cancelled.is_set():
+            raise GenerationCancelled(f"job {self.id} cancelled")
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.perf_counter()
+        self._done.set()
+
+
+class GenerationServer:
+    # runs generations from a bounded queue on a pool of worker threads sharing one engine,
+    # openvino releases the GIL during inference so the UNet steps of in-flight jobs interleave
+    def __init__(self, engine, workers=None, max_queue=16):
+        self.engine = engine
+        if workers is None:
+            workers = engine.unet.get_property("OPTIMAL_NUMBER_OF_INFER_REQUESTS")
+        self.workers = max(1, int(workers))
+        self._queue = queue.Queue(max_queue)
+        self._ids = itertools.count()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"sd-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, prompt, block=True, timeout=None, **kwargs):
+        # queue.Full is raised when the queue stays full for timeout seconds or block is False
+        if kwargs.get("seeds") is None:
+            # jobs run concurrently, so they can not share the global numpy random state
+            seed = random.randint(0, 2**30)
+            kwargs["seeds"] = seed if isinstance(prompt, str) else [seed + i for i in range(len(prompt))]
+        kwargs["prompt"] = prompt
+        job = GenerationJob(next(self._ids), kwargs)
+        self._queue.put(job, block=block, timeout=timeout)
+        return job
+
+    def map(self, prompts, **kwargs):
+        jobs = [self.submit(prompt, **kwargs) for prompt in prompts]
+        return [job.wait() for job in jobs]
+
+    def shutdown(self, wait=True):
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if job._cancelled.is_set():
+                job._finish("cancelled")
+                continue
+            job.status = "running"
+            job.started_at = time.perf_counter()
+            try:
+                image = self.engine(
+                    scheduler=copy.deepcopy(self.engine.scheduler),
+                    callback=job._on_step,
+                    **job.kwargs
+                )
+            except GenerationCancelled:
+                job._finish("cancelled")
+            except Exception as e:
+                job._finish("failed", error=e)
+            else:
+                job._finish("done", result=image)
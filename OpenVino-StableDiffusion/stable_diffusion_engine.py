@@ -1,7 +1,12 @@
 import inspect
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
 # openvino
-from openvino.runtime import Core
+from openvino.runtime import Core, Dimension, PartialShape, Tensor, get_version
 # tokenizer
 from transformers import CLIPTokenizer
 # utils
@@ -9,79 +14,259 @@ from tqdm import tqdm
 from huggingface_hub import hf_hub_download
 from diffusers import LMSDiscreteScheduler, PNDMScheduler
 import cv2
+from tiling import tiled_apply
+from profiling import NO_PROFILE
+
+
+MODEL_NAMES = ("text_encoder", "unet", "vae_decoder", "vae_encoder")
+# bump when the layout of the compiled-model cache changes
+CACHE_VERSION = 1
 
 
 def result(var):
     return next(iter(var.values()))
 
 
+def compiled_cache_dir(root, model, device):
+    # blobs are only valid for one cache layout, openvino build, model and device
+    version = re.sub(r"[^\w.-]", "_", f"v{CACHE_VERSION}-openvino-{get_version()}")
+    return os.path.join(root, version, re.sub(r"[^\w.-]+", "--", model).strip("-"), device)
+
+
+class TextEmbeddingCache:
+    # LRU cache of text encoder outputs keyed by token ids
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tokens):
+        key = tuple(tokens)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, tokens, embedding):
+        if self.max_size <= 0:
+            return
+        key = tuple(tokens)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "max_size": self.max_size
+        }
+
+
 class StableDiffusionEngine:
     def __init__(
             self,
             scheduler,
             model="bes-dev/stable-diffusion-v1-4-openvino",
             tokenizer="openai/clip-vit-large-patch14",
-            device="CPU"
+            device="CPU",
+            text_cache_size=256,
+            cache_dir="./cache",
+            lazy=True,
+            performance_hint=None,
+            profiler=None
     ):
-        self.tokenizer = CLIPTokenizer.from_pretrained(tokenizer)
+        self.tokenizer = CLIPTokenizer.from_pretrained(tokenizer) if isinstance(tokenizer, str) else tokenizer
         self.scheduler = scheduler
+        self.device = device
+        # optional profiling.Profiler that records the wall time of every phase of a call
+        self.profiler = profiler
+        # text embeddings, the unconditional one is computed once and never evicted
+        self.text_cache = TextEmbeddingCache(text_cache_size)
+        self._uncond_embeddings = None
         # models
+        self.model = model
+        self.config = {} if performance_hint is None else {"PERFORMANCE_HINT": performance_hint}
         self.core = Core()
-        self.core.set_property({'CACHE_DIR': './cache'})
+        self.cache_dir = None if cache_dir is None else compiled_cache_dir(cache_dir, model, device)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.core.set_property({'CACHE_DIR': self.cache_dir})
+        # sub-models are read and compiled on first use, timings end up in the startup report
+        self._models = {}
+        self._compiled_models = {}
+        self._batched_models = {}
+        self.startup_report = {}
+        # guards lazy loading when the engine is shared between threads
+        self._lock = threading.RLock()
+        # per-thread infer requests, see _infer
+        self._local = threading.local()
+        if not lazy:
+            for name in MODEL_NAMES:
+                self._compile(name)
 
-        # text features
-        self._text_encoder = self.core.read_model(
-            hf_hub_download(repo_id=model, filename="text_encoder.xml"),
-            hf_hub_download(repo_id=model, filename="text_encoder.bin")
-        )
-        self.text_encoder = self.core.compile_model(self._text_encoder, device)
-        # diffusion
-        self._unet = self.core.read_model(
-            hf_hub_download(repo_id=model, filename="unet.xml"),
-            hf_hub_download(repo_id=model, filename="unet.bin")
-        )
-        self.unet = self.core.compile_model(self._unet, device)
-        self.latent_shape = tuple(self._unet.inputs[0].shape)[1:]
-        # decoder
-        self._vae_decoder = self.core.read_model(
-            hf_hub_download(repo_id=model, filename="vae_decoder.xml"),
-            hf_hub_download(repo_id=model, filename="vae_decoder.bin")
-        )
-        self.vae_decoder = self.core.compile_model(self._vae_decoder, device)
-        # encoder
-        self._vae_encoder = self.core.read_model(
-            hf_hub_download(repo_id=model, filename="vae_encoder.xml"),
-            hf_hub_download(repo_id=model, filename="vae_encoder.bin")
-        )
-        self.vae_encoder = self.core.compile_model(self._vae_encoder, device)
-        self.init_image_shape = tuple(self._vae_encoder.inputs[0].shape)[2:]
+    # text features
+    @property
+    def text_encoder(self):
+        return self._compile("text_encoder")
+
+    # diffusion
+    @property
+    def unet(self):
+        return self._compile("unet")
+
+    @property
+    def latent_shape(self):
+        with self._lock:
+            return tuple(self._read("unet").inputs[0].shape)[1:]
+
+    # decoder
+    @property
+    def vae_decoder(self):
+        return self._compile("vae_decoder")
+
+    # encoder
+    @property
+    def vae_encoder(self):
+        return self._compile("vae_encoder")
 
-    def _preprocess_mask(self, mask):
-        h, w = mask.shape
-        if h != self.init_image_shape[0] and w != self.init_image_shape[1]:
+    @property
+    def init_image_shape(self):
+        with self._lock:
+            return tuple(self._read("vae_encoder").inputs[0].shape)[2:]
+
+    def _read(self, name):
+        with self._lock:
+            return self._read_locked(name)
+
+    def _read_locked(self, name):
+        if name not in self._models:
+            report = self.startup_report.setdefault(name, {})
+            start = time.perf_counter()
+            # model is either a hub repo id or a local directory with the same files
+            if os.path.isdir(self.model):
+                xml = os.path.join(self.model, f"{name}.xml")
+                weights = os.path.join(self.model, f"{name}.bin")
+            else:
+                xml = hf_hub_download(repo_id=self.model, filename=f"{name}.xml")
+                weights = hf_hub_download(repo_id=self.model, filename=f"{name}.bin")
+            report["download"] = time.perf_counter() - start
+            start = time.perf_counter()
+            self._models[name] = self.core.read_model(xml, weights)
+            report["read"] = time.perf_counter() - start
+        return self._models[name]
+
+    def _compile(self, name):
+        with self._lock:
+            return self._compile_locked(name)
+
+    def _compile_locked(self, name):
+        if name not in self._compiled_models:
+            model = self._read(name)
+            report = self.startup_report[name]
+            blobs = self._cached_blobs()
+            start = time.perf_counter()
+            self._compiled_models[name] = self.core.compile_model(model, self.device, self.config)
+            report["compile"] = time.perf_counter() - start
+            # a compile served from the cache does not write a new blob
+            report["cache_hit"] = self.cache_dir is not None and self._cached_blobs() <= blobs
+        return self._compiled_models[name]
+
+    def _cached_blobs(self):
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return set()
+        return {f for f in os.listdir(self.cache_dir) if f.endswith(".blob")}
+
+    def startup_summary(self):
+        lines = [f"{'model':<14}{'download':>10}{'read':>10}{'compile':>10}  cache"]
+        for name, report in self.startup_report.items():
+            cache = "-" if "compile" not in report else ("hit" if report["cache_hit"] else "miss")
+            lines.append(
+                f"{name:<14}{report.get('download', 0.0):>9.2f}s{report.get('read', 0.0):>9.2f}s"
+                f"{report.get('compile', 0.0):>9.2f}s  {cache}"
+            )
+        return "\n".join(lines)
+
+    def _batched(self, name, batch_size):
+        with self._lock:
+            return self._batched_locked(name, batch_size)
+
+    def _batched_locked(self, name, batch_size):
+        model = self._read(name)
+        leading = model.inputs[0].get_partial_shape()[0]
+        if leading.is_dynamic or leading.get_length() == batch_size:
+            return self._compile(name)
+        key = (name, batch_size)
+        if key not in self._batched_models:
+            # only batch-major inputs are reshaped, scalar inputs like the timestep stay as they are
+            new_shapes, old_shapes = {}, {}
+            for port in model.inputs:
+                shape = port.get_partial_shape()
+                if len(shape) > 1:
+                    old_shapes[port.any_name] = shape
+                    new_shapes[port.any_name] = PartialShape(
+                        [Dimension(batch_size)] + [shape[i] for i in range(1, len(shape))]
+                    )
+            model.reshape(new_shapes)
+            self._batched_models[key] = self.core.compile_model(model, self.device, self.config)
+            # keep the read model at its native shape for _compile and the shape properties
+            model.reshape(old_shapes)
+        return self._batched_models[key]
+
+    def _phase(self, name, step=None):
+        return getattr(self._local, "profile", NO_PROFILE).phase(name, step)
+
+    def _request(self, compiled_model):
+        # every thread keeps one infer request per compiled model and reuses it across calls
+        requests = getattr(self._local, "requests", None)
+        if requests is None:
+            requests = self._local.requests = {}
+        request = requests.get(id(compiled_model))
+        if request is None:
+            request = requests[id(compiled_model)] = compiled_model.create_infer_request()
+        return request
+
+    def _infer(self, compiled_model, inputs):
+        return result(self._request(compiled_model).infer(inputs))
+
+    def _preprocess_mask(self, mask, shape=None):
+        shape = self.init_image_shape if shape is None else shape
+        if mask.shape != tuple(shape):
             mask = cv2.resize(
                 mask,
-                (self.init_image_shape[1], self.init_image_shape[0]),
+                (shape[1], shape[0]),
                 interpolation = cv2.INTER_NEAREST
             )
         mask = cv2.resize(
             mask,
-            (self.init_image_shape[1] // 8, self.init_image_shape[0] // 8),
+            (shape[1] // 8, shape[0] // 8),
             interpolation = cv2.INTER_NEAREST
         )
         mask = mask.astype(np.float32) / 255.0
-        mask = np.tile(mask, (4, 1, 1))
-        mask = mask[None].transpose(0, 1, 2, 3)
+        # a single channel broadcasts over the 4 latent channels
+        mask = mask[None, None]
         mask = 1 - mask
         return mask
 
-    def _preprocess_image(self, image):
+    def _preprocess_image(self, image, shape=None):
+        shape = self.init_image_shape if shape is None else shape
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        h, w = image.shape[1:]
-        if h != self.init_image_shape[0] and w != self.init_image_shape[1]:
+        if image.shape[:2] != tuple(shape):
             image = cv2.resize(
                 image,
-                (self.init_image_shape[1], self.init_image_shape[0]),
+                (shape[1], shape[0]),
                 interpolation=cv2.INTER_LANCZOS4
             )
         # normalize
@@ -91,14 +276,62 @@ class StableDiffusionEngine:
         image = image[None].transpose(0, 3, 1, 2)
         return image
 
-    def _encode_image(self, init_image):
-        moments = result(self.vae_encoder.infer_new_request({
-            "init_image": self._preprocess_image(init_image)
-        }))
+    def _tokenize(self, prompts):
+        return self.tokenizer(
+            prompts,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True
+        ).input_ids
+
+    def _encode_text(self, prompts):
+        with self._phase("tokenize"):
+            tokens = self._tokenize(prompts)
+        embeddings = [self.text_cache.get(ids) for ids in tokens]
+        encoded = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is not None:
+                continue
+            # misses run one at a time on the native batch-1 encoder, a batched encoder would be
+            # compiled again, with its own copy of the weights, for every number of misses
+            key = tuple(tokens[i])
+            if key not in encoded:
+                with self._phase("text_encoder"):
+                    encoded[key] = self._infer(self.text_encoder, {"tokens": np.array([tokens[i]])})[0].copy()
+                self.text_cache.put(tokens[i], encoded[key])
+            embeddings[i] = encoded[key]
+        return np.stack(embeddings)
+
+    def _encode_uncond(self):
+        if self._uncond_embeddings is None:
+            with self._phase("text_encoder"):
+                self._uncond_embeddings = self._infer(
+                    self.text_encoder, {"tokens": np.array(self._tokenize([""]))}
+                ).copy()
+        return self._uncond_embeddings
+
+    def _tiled_shape(self, image):
+        # full-resolution size rounded down to the latent grid, None if the image fits in one tile
+        h, w = image.shape[0] // 8 * 8, image.shape[1] // 8 * 8
+        if h <= self.init_image_shape[0] and w <= self.init_image_shape[1]:
+            return None
+        return max(h, self.init_image_shape[0]), max(w, self.init_image_shape[1])
+
+    def _encode_image(self, init_image, rngs=(np.random,), shape=None, tile_overlap=64):
+        image = self._preprocess_image(init_image, shape)
+        with self._phase("vae_encoder"):
+            if shape is None:
+                moments = self._infer(self.vae_encoder, {"init_image": image})
+            else:
+                moments = tiled_apply(
+                    lambda tile: self._infer(self.vae_encoder, {"init_image": tile}),
+                    image, self.init_image_shape, tile_overlap
+                )
         mean, logvar = np.split(moments, 2, axis=1)
         std = np.exp(logvar * 0.5)
-        latent = (mean + std * np.random.randn(*mean.shape)) * 0.18215
-        return latent
+        # the image is encoded once, every rng samples its own latent from the same moments
+        latents = [(mean + std * rng.randn(*mean.shape)) * 0.18215 for rng in rngs]
+        return np.concatenate(latents, axis=0)
 
     def __call__(
             self,
@@ -108,107 +341,237 @@ class StableDiffusionEngine:
             strength = 0.5,
             num_inference_steps = 32,
             guidance_scale = 7.5,
-            eta = 0.0
+            eta = 0.0,
+            seeds = None,
+            scheduler = None,
+            callback = None,
+            tiled = False,
+            tile_overlap = 64,
+            lean = False
     ):
-        # extract condition
-        tokens = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True
-        ).input_ids
-        text_embeddings = result(
-            self.text_encoder.infer_new_request({"tokens": np.array([tokens])})
+        # concurrent callers pass their own scheduler, the schedulers keep per-generation state
+        scheduler = self.scheduler if scheduler is None else scheduler
+
+        # a list of prompts is generated as one batch, one image per prompt
+        batched = not isinstance(prompt, str)
+        prompts = list(prompt) if batched else [prompt]
+        batch_size = len(prompts)
+
+        # one random stream per image, seeded streams match np.random.seed(seed) followed by a single call
+        if seeds is None:
+            rngs = [np.random] * batch_size
+        else:
+            if isinstance(seeds, int):
+                seeds = [seeds]
+            if len(seeds) != batch_size:
+                raise ValueError(f"got {len(seeds)} seeds for {batch_size} prompts")
+            rngs = [np.random.RandomState(seed) for seed in seeds]
+
+        profile = NO_PROFILE if self.profiler is None else self.profiler.begin(
+            prompts=batch_size,
+            steps=num_inference_steps,
+            img2img=init_image is not None,
+            inpaint=mask is not None
         )
+        self._local.profile = profile
+        try:
+            images = self._generate(
+                prompts, rngs, init_image, mask, strength, num_inference_steps, guidance_scale, eta,
+                scheduler, callback, tiled, tile_overlap, lean
+            )
+        except BaseException as e:
+            if profile is not NO_PROFILE:
+                profile.meta["error"] = type(e).__name__
+            raise
+        finally:
+            # closed however the call ends, a cancelled job must not leave its profile on the worker thread
+            self._local.profile = NO_PROFILE
+            if profile is not NO_PROFILE:
+                self.profiler.end(profile)
+        return images if batched else images[0]
+
+    def _generate(
+            self, prompts, rngs, init_image, mask, strength, num_inference_steps, guidance_scale, eta,
+            scheduler, callback, tiled, tile_overlap, lean
+    ):
+        batch_size = len(prompts)
+
+        # extract condition
+        text_embeddings = self._encode_text(prompts)
 
         # do classifier free guidance
         if guidance_scale > 1.0:
-            tokens_uncond = self.tokenizer(
-                "",
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length,
-                truncation=True
-            ).input_ids
-            uncond_embeddings = result(
-                self.text_encoder.infer_new_request({"tokens": np.array([tokens_uncond])})
-            )
+            uncond_embeddings = np.repeat(self._encode_uncond(), batch_size, axis=0)
             text_embeddings = np.concatenate((uncond_embeddings, text_embeddings), axis=0)
 
         # set timesteps
-        accepts_offset = "offset" in set(inspect.signature(self.scheduler.set_timesteps).parameters.keys())
+        accepts_offset = "offset" in set(inspect.signature(scheduler.set_timesteps).parameters.keys())
         extra_set_kwargs = {}
         offset = 0
         if accepts_offset:
             offset = 1
             extra_set_kwargs["offset"] = 1
 
-        self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
+        scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
+
+        # large init images are processed at full resolution in overlapping tiles of the native model size
+        image_shape = self._tiled_shape(init_image) if tiled and init_image is not None else None
+        latent_shape = self.latent_shape
+        if image_shape is not None:
+            latent_shape = (latent_shape[0], image_shape[0] // 8, image_shape[1] // 8)
 
         # initialize latent latent
         if init_image is None:
-            latents = np.random.randn(*self.latent_shape)
+            latents = np.stack([rng.randn(*latent_shape) for rng in rngs])
             init_timestep = num_inference_steps
         else:
-            init_latents = self._encode_image(init_image)
+            init_latents = self._encode_image(init_image, rngs, image_shape, tile_overlap)
             init_timestep = int(num_inference_steps * strength) + offset
             init_timestep = min(init_timestep, num_inference_steps)
-            timesteps = np.array([[self.scheduler.timesteps[-init_timestep]]]).astype(np.long)
-            noise = np.random.randn(*self.latent_shape)
-            latents = self.scheduler.add_noise(init_latents, noise, timesteps)[0]
+            timesteps = np.array([[scheduler.timesteps[-init_timestep]]]).astype(np.long)
+            noise = np.stack([rng.randn(*latent_shape) for rng in rngs])
+            latents = scheduler.add_noise(init_latents, noise, timesteps)
 
         if init_image is not None and mask is not None:
-            mask = self._preprocess_mask(mask)
+            mask = self._preprocess_mask(mask, image_shape)
         else:
             mask = None
 
         # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-        if isinstance(self.scheduler, LMSDiscreteScheduler):
-            latents = latents * self.scheduler.sigmas[0]
+        if isinstance(scheduler, LMSDiscreteScheduler):
+            latents = latents * scheduler.sigmas[0]
 
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_eta = "eta" in set(inspect.signature(scheduler.step).parameters.keys())
         extra_step_kwargs = {}
         if accepts_eta:
             extra_step_kwargs["eta"] = eta
 
+        unet = self._batched("unet", batch_size * 2 if guidance_scale > 1.0 else batch_size)
+
+        # the memory-lean loop runs in float32 and writes the unet inputs straight into the
+        # infer request tensors, so the per-step temporaries of the default loop are never allocated
+        lean = lean and image_shape is None
+        if lean:
+            latents = latents.astype(np.float32)
+            if mask is not None:
+                init_latents = init_latents.astype(np.float32)
+                noise = noise.astype(np.float32)
+            request = self._request(unet)
+            # the tensors are owned here and bound to the request, their numpy views stay valid for the whole loop
+            bound = {port.any_name: Tensor(port.get_element_type(), port.shape) for port in unet.inputs}
+            for name, tensor in bound.items():
+                request.set_tensor(name, tensor)
+            output_tensor = Tensor(unet.outputs[0].get_element_type(), unet.outputs[0].shape)
+            request.set_output_tensor(0, output_tensor)
+            model_input = bound["latent_model_input"].data
+            model_t = bound["t"].data
+            bound["encoder_hidden_states"].data[...] = text_embeddings
+            model_output = output_tensor.data
+            noise_pred_buffer = np.empty(latents.shape, dtype=np.float32)
+            if mask is not None:
+                noised_buffer = np.empty(latents.shape, dtype=np.float32)
+                noise_term = np.empty(latents.shape, dtype=np.float32)
         t_start = max(num_inference_steps - init_timestep + offset, 0)
-        for i, t in tqdm(enumerate(self.scheduler.timesteps[t_start:])):
-            # expand the latents if we are doing classifier free guidance
-            latent_model_input = np.stack([latents, latents], 0) if guidance_scale > 1.0 else latents[None]
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                sigma = self.scheduler.sigmas[i]
-                latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
-
-            # predict the noise residual
-            noise_pred = result(self.unet.infer_new_request({
-                "latent_model_input": latent_model_input,
-                "t": np.float64(t),
-                "encoder_hidden_states": text_embeddings
-            }))
-
-            # perform guidance
-            if guidance_scale > 1.0:
-                noise_pred = noise_pred[0] + guidance_scale * (noise_pred[1] - noise_pred[0])
+        num_steps = len(scheduler.timesteps[t_start:])
+        for i, t in tqdm(enumerate(scheduler.timesteps[t_start:])):
+            if lean:
+                scale = 1.0
+                if isinstance(scheduler, LMSDiscreteScheduler):
+                    scale = 1 / ((scheduler.sigmas[i]**2 + 1) ** 0.5)
+                np.multiply(latents, scale, out=model_input[:batch_size])
+                if guidance_scale > 1.0:
+                    model_input[batch_size:] = model_input[:batch_size]
+                model_t[...] = t
 
-            # compute the previous noisy sample x_t -> x_t-1
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                latents = self.scheduler.step(noise_pred, i, latents, **extra_step_kwargs)["prev_sample"]
+                with self._phase("unet", i):
+                    request.infer()
+
+                # PNDMScheduler keeps references to past model outputs, so it needs a fresh array
+                noise_pred = np.empty_like(noise_pred_buffer) if isinstance(scheduler, PNDMScheduler) else noise_pred_buffer
+                if guidance_scale > 1.0:
+                    np.subtract(model_output[batch_size:], model_output[:batch_size], out=noise_pred)
+                    noise_pred *= guidance_scale
+                    noise_pred += model_output[:batch_size]
+                else:
+                    np.copyto(noise_pred, model_output)
             else:
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs)["prev_sample"]
+                # expand the latents if we are doing classifier free guidance
+                latent_model_input = np.concatenate([latents, latents], 0) if guidance_scale > 1.0 else latents
+                if isinstance(scheduler, LMSDiscreteScheduler):
+                    sigma = scheduler.sigmas[i]
+                    latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
+
+                # predict the noise residual
+                with self._phase("unet", i):
+                    if image_shape is None:
+                        noise_pred = self._infer(unet, {
+                            "latent_model_input": latent_model_input,
+                            "t": np.float64(t),
+                            "encoder_hidden_states": text_embeddings
+                        })
+                    else:
+                        noise_pred = tiled_apply(
+                            lambda tile: self._infer(unet, {
+                                "latent_model_input": tile,
+                                "t": np.float64(t),
+                                "encoder_hidden_states": text_embeddings
+                            }),
+                            latent_model_input, self.latent_shape[1:], tile_overlap // 8
+                        )
+
+                # perform guidance
+                if guidance_scale > 1.0:
+                    noise_pred_uncond, noise_pred_text = noise_pred[:batch_size], noise_pred[batch_size:]
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+            # compute the previous noisy sample x_t -> x_t-1
+            with self._phase("scheduler_step", i):
+                if isinstance(scheduler, LMSDiscreteScheduler):
+                    latents = scheduler.step(noise_pred, i, latents, **extra_step_kwargs)["prev_sample"]
+                else:
+                    latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs)["prev_sample"]
 
             # masking for inapinting
             if mask is not None:
-                init_latents_proper = self.scheduler.add_noise(init_latents, noise, t)
-                latents = ((init_latents_proper * mask) + (latents * (1 - mask)))[0]
+                with self._phase("mask_blend", i):
+                    if lean:
+                        # add_noise of the schedulers, sqrt(alpha_prod) * init_latents + sqrt(1 - alpha_prod) * noise,
+                        # written into the preallocated buffers
+                        alpha_prod = scheduler.alphas_cumprod[t]
+                        np.multiply(noise, (1 - alpha_prod) ** 0.5, out=noise_term)
+                        np.multiply(init_latents, alpha_prod ** 0.5, out=noised_buffer)
+                        noised_buffer += noise_term
+                        # latents + (init_latents_proper - latents) * mask, in place
+                        np.subtract(noised_buffer, latents, out=noised_buffer)
+                        noised_buffer *= mask
+                        latents += noised_buffer
+                    else:
+                        init_latents_proper = scheduler.add_noise(init_latents, noise, t)
+                        latents = (init_latents_proper * mask) + (latents * (1 - mask))
 
-        image = result(self.vae_decoder.infer_new_request({
-            "latents": np.expand_dims(latents, 0)
-        }))
+            # report progress, the callback may raise to abort the generation
+            if callback is not None:
+                callback(i + 1, num_steps)
 
-        # convert tensor to opencv's image format
-        image = (image / 2 + 0.5).clip(0, 1)
-        image = (image[0].transpose(1, 2, 0)[:, :, ::-1] * 255).astype(np.uint8)
-        return image
+        images = []
+        for latent in latents:
+            with self._phase("vae_decoder"):
+                if image_shape is None:
+                    image = self._infer(self.vae_decoder, {
+                        "latents": np.expand_dims(latent, 0)
+                    })
+                else:
+                    image = tiled_apply(
+                        lambda tile: self._infer(self.vae_decoder, {"latents": tile}),
+                        np.expand_dims(latent, 0), self.latent_shape[1:], tile_overlap // 8
+                    )
+
+            # convert tensor to opencv's image format
+            image = (image / 2 + 0.5).clip(0, 1)
+            image = (image[0].transpose(1, 2, 0)[:, :, ::-1] * 255).astype(np.uint8)
+            images.append(image)
+        return images
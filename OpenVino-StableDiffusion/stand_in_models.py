@@ -0,0 +1,93 @@
+import os
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+from openvino.runtime import Model, serialize
+from openvino.runtime import opset8 as ops
+
+
+# tiny IR models with the input/output names of the real pipeline, for offline benchmarks
+VOCAB_SIZE = 49408
+BOS, EOS = 49406, 49407
+
+
+class StandInTokenizer:
+    # deterministic word-level stand-in for CLIPTokenizer, ids stay inside the CLIP vocabulary
+    model_max_length = 77
+
+    def __call__(self, prompts, padding="max_length", max_length=77, truncation=True):
+        single = isinstance(prompts, str)
+        if single:
+            prompts = [prompts]
+        input_ids = []
+        for prompt in prompts:
+            ids = [BOS] + [zlib.crc32(word.encode()) % (BOS - 1) + 1 for word in prompt.split()]
+            ids = ids[:max_length - 1] + [EOS]
+            input_ids.append(ids + [EOS] * (max_length - len(ids)))
+        return SimpleNamespace(input_ids=input_ids[0] if single else input_ids)
+
+
+def _weights(rng, *shape):
+    # cast last, under NumPy 2 the float64 scale would promote a float32 array
+    return ops.constant((rng.standard_normal(shape) / np.sqrt(np.prod(shape[1:]))).astype(np.float32))
+
+
+def _conv(x, rng, in_channels, out_channels, kernel=3):
+    pad = kernel // 2
+    return ops.convolution(
+        x, _weights(rng, out_channels, in_channels, kernel, kernel),
+        strides=[1, 1], pads_begin=[pad, pad], pads_end=[pad, pad], dilations=[1, 1]
+    )
+
+
+def text_encoder(rng, hidden_size, max_length=77):
+    tokens = ops.parameter([1, max_length], np.int64, name="tokens")
+    embeddings = ops.gather(_weights(rng, VOCAB_SIZE, hidden_size), tokens, ops.constant(0))
+    hidden = ops.tanh(ops.matmul(embeddings, _weights(rng, hidden_size, hidden_size), False, False))
+    return Model([hidden], [tokens], "text_encoder")
+
+
+def unet(rng, latent_size, hidden_size, channels, max_length=77):
+    latents = ops.parameter([2, 4, latent_size, latent_size], np.float32, name="latent_model_input")
+    # the engine feeds the timestep as float64
+    t = ops.parameter([], np.float64, name="t")
+    context = ops.parameter([2, max_length, hidden_size], np.float32, name="encoder_hidden_states")
+    x = ops.relu(_conv(latents, rng, 4, channels))
+    # condition on the mean text embedding and the timestep
+    pooled = ops.matmul(ops.reduce_mean(context, ops.constant([1]), False), _weights(rng, hidden_size, channels), False, False)
+    x = ops.add(x, ops.unsqueeze(pooled, ops.constant([2, 3])))
+    t_scaled = ops.multiply(ops.convert(t, np.float32), ops.constant(np.float32(1e-3)))
+    x = ops.add(x, ops.unsqueeze(t_scaled, ops.constant([0, 1, 2, 3])))
+    x = ops.relu(_conv(x, rng, channels, channels))
+    return Model([_conv(x, rng, channels, 4)], [latents, t, context], "unet")
+
+
+def vae_decoder(rng, latent_size, channels):
+    latents = ops.parameter([1, 4, latent_size, latent_size], np.float32, name="latents")
+    x = ops.relu(_conv(latents, rng, 4, channels))
+    x = ops.depth_to_space(_conv(x, rng, channels, 3 * 64, kernel=1), "blocks_first", 8)
+    return Model([ops.tanh(x)], [latents], "vae_decoder")
+
+
+def vae_encoder(rng, image_size, channels):
+    image = ops.parameter([1, 3, image_size, image_size], np.float32, name="init_image")
+    x = ops.space_to_depth(image, "blocks_first", 8)
+    x = ops.relu(_conv(x, rng, 3 * 64, channels, kernel=1))
+    # mean and logvar of the latent distribution
+    return Model([_conv(x, rng, channels, 8)], [image], "vae_encoder")
+
+
+def make_stand_in_models(path, image_size=128, hidden_size=64, channels=64, seed=0):
+    rng = np.random.default_rng(seed)
+    latent_size = image_size // 8
+    models = {
+        "text_encoder": text_encoder(rng, hidden_size),
+        "unet": unet(rng, latent_size, hidden_size, channels),
+        "vae_decoder": vae_decoder(rng, latent_size, channels),
+        "vae_encoder": vae_encoder(rng, image_size, channels)
+    }
+    os.makedirs(path, exist_ok=True)
+    for name, model in models.items():
+        serialize(model, os.path.join(path, f"{name}.xml"), os.path.join(path, f"{name}.bin"))
+    return path
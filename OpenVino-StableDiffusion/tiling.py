@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def tile_positions(size, tile, overlap):
+    # start offsets of overlapping tiles covering [0, size), the last tile is aligned to the end
+    if size <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def blend_weights(height, width, overlap):
+    # 1 in the tile interior, linear ramps over the overlap so neighbouring tiles cross-fade
+    def ramp(n):
+        weights = np.ones(n, dtype=np.float32)
+        k = min(overlap, n // 2)
+        if k > 0:
+            edge = np.arange(1, k + 1, dtype=np.float32) / (k + 1)
+            weights[:k] = edge
+            weights[-k:] = edge[::-1]
+        return weights
+    return np.outer(ramp(height), ramp(width))
+
+
+def tiled_apply(fn, x, tile, overlap):
+    """Apply fn to overlapping (tile[0], tile[1]) windows of an NCHW array and blend the outputs.
+
+    fn may change the channel count and scale the spatial size by a constant factor
+    (8x for the VAE decoder, 1/8x for the encoder), only one tile is processed at a time.
+    """
+    n, _, h, w = x.shape
+    th, tw = min(tile[0], h), min(tile[1], w)
+    out = weight = None
+    for y in tile_positions(h, th, overlap):
+        for x0 in tile_positions(w, tw, overlap):
+            y_tile = fn(x[:, :, y:y + th, x0:x0 + tw])
+            if out is None:
+                scale_h, scale_w = y_tile.shape[2] / th, y_tile.shape[3] / tw
+                out = np.zeros((n, y_tile.shape[1], round(h * scale_h), round(w * scale_w)), dtype=np.float32)
+                weight = np.zeros(out.shape[2:], dtype=np.float32)
+                tile_weight = blend_weights(y_tile.shape[2], y_tile.shape[3], round(overlap * min(scale_h, scale_w)))
+            top, left = round(y * scale_h), round(x0 * scale_w)
+            bottom, right = top + y_tile.shape[2], left + y_tile.shape[3]
+            out[:, :, top:bottom, left:right] += y_tile * tile_weight
+            weight[top:bottom, left:right] += tile_weight
+    return out / weight
@@ -0,0 +1,125 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from mask_to_polygon import format_labels, mask_to_polygons
+
+
+# compact per-instance mask files written by predict.py at model resolution,
+# load_masks renders them at full resolution only when asked to
+
+
+def encode_rle(mask):
+    # uncompressed COCO RLE: column-major run lengths, starting with a run of zeros
+    h, w = mask.shape
+    pixels = (mask > 0).ravel(order='F')
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [pixels.size])))
+    if pixels.size and pixels[0]:
+        counts = np.concatenate(([0], counts))
+    return {'size': [h, w], 'counts': counts.tolist()}
+
+
+def decode_rle(rle):
+    h, w = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = (np.arange(len(counts)) % 2).astype(np.uint8)
+    return np.repeat(values, counts).reshape((h, w), order='F')
+
+
+def save_rle(path, masks, orig_shape, classes):
+    with open(path, 'w') as f:
+        json.dump({
+            'orig_shape': list(orig_shape[:2]),
+            'instances': [dict(encode_rle(mask), category_id=int(c)) for mask, c in zip(masks, classes)]
+        }, f)
+
+
+def save_packed(path, masks, orig_shape, classes):
+    # one bit per pixel, packed along the rows, the runs of empty bytes compress well
+    np.savez_compressed(
+        path,
+        packed=np.packbits(masks > 0, axis=-1),
+        shape=np.array(masks.shape),
+        orig_shape=np.array(orig_shape[:2]),
+        classes=np.asarray(classes, dtype=np.int32)
+    )
+
+
+def save_polygons(path, masks, orig_shape, classes, min_area=0):
+    # same format as the training labels from mask_to_polygon.py, coordinates are normalized
+    # by the mask size and the mask covers the whole image, so they hold at any resolution
+    with open(path, 'w') as f:
+        f.write(''.join(
+            format_labels(mask_to_polygons(mask.astype(np.uint8) * 255, min_area), int(c))
+            for mask, c in zip(masks, classes)
+        ))
+
+
+def _load_rle(path):
+    with open(path) as f:
+        data = json.load(f)
+    masks = [decode_rle(instance) for instance in data['instances']]
+    classes = np.array([instance.get('category_id', 0) for instance in data['instances']], dtype=np.int32)
+    shape = data['instances'][0]['size'] if masks else data['orig_shape']
+    masks = np.stack(masks) if masks else np.zeros((0,) + tuple(shape), dtype=np.uint8)
+    return masks, classes, tuple(data['orig_shape'])
+
+
+def _load_packed(path):
+    data = np.load(path)
+    n, h, w = data['shape']
+    masks = np.unpackbits(data['packed'], axis=-1, count=w)[:n, :h]
+    return masks, data['classes'], tuple(data['orig_shape'])
+
+
+def _load_polygons(path, shape):
+    masks, classes = [], []
+    with open(path) as f:
+        for line in f:
+            values = line.split()
+            if not values:
+                continue
+            polygon = np.array(values[1:], dtype=np.float64).reshape(-1, 2) * (shape[1], shape[0])
+            mask = np.zeros(shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [np.round(polygon).astype(np.int32)], 1)
+            masks.append(mask)
+            classes.append(int(values[0]))
+    masks = np.stack(masks) if masks else np.zeros((0,) + tuple(shape[:2]), dtype=np.uint8)
+    return masks, np.array(classes, dtype=np.int32), tuple(shape[:2])
+
+
+def load_masks(path, full_resolution=True, shape=None):
+    """Read a mask file written by predict.py and return (masks, classes).
+
+    masks is an (N, h, w) uint8 array of 0/1 instance masks, at model resolution unless
+    full_resolution is set. Polygon files carry no image size, pass the (H, W) shape to rasterize them.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.json':
+        masks, classes, orig_shape = _load_rle(path)
+    elif ext == '.npz':
+        masks, classes, orig_shape = _load_packed(path)
+    elif ext == '.txt':
+        if shape is None:
+            raise ValueError('polygon files need the image shape to be rasterized')
+        masks, classes, _ = _load_polygons(path, shape)
+        return masks, classes
+    else:
+        raise ValueError('unknown mask file {}'.format(path))
+    if full_resolution:
+        masks = render(masks, orig_shape)
+    return masks, classes
+
+
+def render(masks, shape):
+    # nearest-neighbour upscale of (N, h, w) masks to the (H, W) image size
+    H, W = shape[:2]
+    if masks.shape[1:] == (H, W):
+        return masks
+    out = np.empty((len(masks), H, W), dtype=masks.dtype)
+    for i, mask in enumerate(masks):
+        out[i] = cv2.resize(mask, (W, H), interpolation=cv2.INTER_NEAREST)
+    return out
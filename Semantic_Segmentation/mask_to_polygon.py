@@ -1,40 +1,161 @@
+import argparse
+import hashlib
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
+import numpy as np
 
 
-input_dir = './data/masks'
-output_dir = './data/labels'
+MASK_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+# kept in the output directory, records what every label file was generated from
+MANIFEST_NAME = '.mask_to_polygon.json'
+# bump when the label format changes so old manifests trigger a full reconversion
+MANIFEST_VERSION = 1
 
-for j in os.listdir(input_dir):
-    image_path = os.path.join(input_dir, j)
-    # load the binary mask and get its contours
-    mask = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+def mask_to_polygons(mask, min_area=200):
+    # binarize the mask and get the external contours
     _, mask = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
 
     H, W = mask.shape
     contours, hierarchy = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    # convert the contours to polygons
-    polygons = []
-    for cnt in contours:
-        if cv2.contourArea(cnt) > 200:
-            polygon = []
-            for point in cnt:
-                x, y = point[0]
-                polygon.append(x / W)
-                polygon.append(y / H)
-            polygons.append(polygon)
-
-    # print the polygons
-    with open('{}.txt'.format(os.path.join(output_dir, j)[:-4]), 'w') as f:
-        for polygon in polygons:
-            for p_, p in enumerate(polygon):
-                if p_ == len(polygon) - 1:
-                    f.write('{}\n'.format(p))
-                elif p_ == 0:
-                    f.write('0 {} '.format(p))
-                else:
-                    f.write('{} '.format(p))
-
-        f.close()
\ No newline at end of file
+    # convert the contours to polygons normalized by the image size
+    scale = np.array([W, H], dtype=np.float64)
+    return [
+        (cnt.reshape(-1, 2) / scale).ravel()
+        for cnt in contours
+        if cv2.contourArea(cnt) > min_area
+    ]
+
+
+def format_labels(polygons, class_id=0):
+    # one line per polygon: class x1 y1 x2 y2 ...
+    return ''.join(
+        '{} {}\n'.format(class_id, ' '.join(map(str, polygon.tolist())))
+        for polygon in polygons
+    )
+
+
+def label_path(mask_name, output_dir):
+    return os.path.join(output_dir, os.path.splitext(mask_name)[0] + '.txt')
+
+
+def convert_mask(mask_path, output_dir, min_area=200, class_id=0, known_hash=None):
+    # the mask is read once for both the content hash and the decode
+    with open(mask_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    label = label_path(os.path.basename(mask_path), output_dir)
+    if digest == known_hash and os.path.exists(label):
+        # touched but unchanged
+        return digest, None
+
+    mask = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError('could not read mask {}'.format(mask_path))
+    polygons = mask_to_polygons(mask, min_area)
+
+    # write the whole label file at once
+    with open(label, 'w') as f:
+        f.write(format_labels(polygons, class_id))
+    return digest, len(polygons)
+
+
+def _convert(job):
+    return convert_mask(*job)
+
+
+def list_masks(input_dir):
+    return sorted(j for j in os.listdir(input_dir) if j.lower().endswith(MASK_EXTENSIONS))
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def convert_dir(input_dir, output_dir, min_area=200, class_id=0, workers=None, chunksize=64, incremental=False):
+    """Convert every mask in input_dir and return a summary of the work done.
+
+    With incremental=True only masks that are new or changed since the last run are converted,
+    a mask counts as unchanged when its size and mtime match the manifest or, failing that,
+    its content hash does. Conversion parameters that differ from the manifest force a full run.
+    Labels of masks that were deleted since the last run are removed in both modes.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    params = {'version': MANIFEST_VERSION, 'min_area': min_area, 'class_id': class_id}
+    manifest = load_manifest(output_dir)
+    previous = manifest.get('masks', {})
+    known = previous if incremental and manifest.get('params') == params else {}
+
+    names = list_masks(input_dir)
+    masks, jobs = {}, []
+    summary = {'converted': 0, 'unchanged': 0, 'skipped': 0, 'removed': 0, 'polygons': 0}
+    for name in names:
+        path = os.path.join(input_dir, name)
+        stat = os.stat(path)
+        entry = known.get(name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns \
+                and os.path.exists(label_path(name, output_dir)):
+            masks[name] = entry
+            summary['skipped'] += 1
+        else:
+            masks[name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            jobs.append((path, output_dir, min_area, class_id, entry['sha1'] if entry else None))
+
+    if workers == 1 or len(jobs) <= 1:
+        results = list(map(_convert, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_convert, jobs, chunksize=chunksize))
+    for job, (digest, n_polygons) in zip(jobs, results):
+        masks[os.path.basename(job[0])]['sha1'] = digest
+        if n_polygons is None:
+            summary['unchanged'] += 1
+        else:
+            summary['converted'] += 1
+            summary['polygons'] += n_polygons
+
+    # drop the labels of masks that no longer exist
+    for name in set(previous) - set(masks):
+        label = label_path(name, output_dir)
+        if os.path.exists(label):
+            os.remove(label)
+            summary['removed'] += 1
+
+    save_manifest(output_dir, {'params': params, 'masks': masks})
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert binary masks to YOLO segmentation labels.')
+    parser.add_argument('--input-dir', default='./data/masks', help='directory with the mask images')
+    parser.add_argument('--output-dir', default='./data/labels', help='directory for the label files')
+    parser.add_argument('--min-area', type=float, default=200, help='contours with a smaller area are dropped')
+    parser.add_argument('--class-id', type=int, default=0, help='class id written at the start of every polygon')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, defaults to the number of cores')
+    parser.add_argument('--chunksize', type=int, default=64, help='masks handed to a process at a time')
+    parser.add_argument('--incremental', action='store_true', help='only convert masks that are new or changed since the last run')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    summary = convert_dir(
+        args.input_dir, args.output_dir, args.min_area, args.class_id, args.workers, args.chunksize, args.incremental
+    )
+    print('converted {converted} masks ({polygons} polygons), skipped {skipped} unchanged by mtime, '
+          '{unchanged} unchanged by content, removed {removed} stale labels'.format(**summary))
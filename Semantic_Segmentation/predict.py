@@ -1,24 +1,203 @@
-from ultralytics import YOLO
+import argparse
+import glob
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
+from ultralytics import YOLO
+
+from mask_formats import render, save_packed, save_polygons, save_rle
 
 
 model_path = 'C:/Users/tvrr28/semantc_segmentation/train6/weights/last.pt'
 
 image_path = 'C:/Users/tvrr28/semantc_segmentation/data/images/val/tigers (41).jpg'
 
-img = cv2.imread(image_path)
-H, W, _ = img.shape
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# compact formats keep one mask per instance at model resolution, see mask_formats.load_masks
+COMPACT_FORMATS = {
+    'rle': ('.json', save_rle),
+    'packed': ('.npz', save_packed),
+    'polygon': ('.txt', save_polygons),
+}
+
+
+def collect_inputs(sources):
+    # directories, glob patterns, image files and .txt files listing one image per line
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths += sorted(
+                os.path.join(source, f) for f in os.listdir(source) if f.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        elif source.lower().endswith('.txt'):
+            with open(source) as f:
+                paths += [line.strip() for line in f if line.strip()]
+        elif glob.has_magic(source):
+            paths += sorted(glob.glob(source, recursive=True))
+        else:
+            paths.append(source)
+    return paths
+
+
+def load_images(paths, workers=4, prefetch=32):
+    # decode in background threads, at most prefetch images are held ahead of the consumer
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(cv2.imread, path)))
+            if len(pending) >= prefetch:
+                yield pending[0][0], pending.popleft()[1].result()
+        while pending:
+            yield pending[0][0], pending.popleft()[1].result()
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def combine_masks(masks, mode='union'):
+    # masks: (N, h, w) instance masks at model resolution
+    masks = masks > 0.5
+    if mode == 'union':
+        return masks.any(axis=0).astype(np.uint8) * 255
+    if mode == 'label':
+        # pixel value is the 1-based index of the instance covering it, later instances win
+        index = np.arange(1, len(masks) + 1, dtype=np.uint16)[:, None, None]
+        return (masks * index).max(axis=0) if len(masks) else np.zeros(masks.shape[1:], dtype=np.uint16)
+    if mode == 'stack':
+        return masks.astype(np.uint8) * 255
+    raise ValueError('unknown mask mode {}'.format(mode))
+
+
+def crop_letterbox(mask, orig_shape):
+    # drop the letterbox padding of the model input, the result covers exactly the original image
+    h, w = mask.shape[-2:]
+    H, W = orig_shape[:2]
+    gain = min(h / H, w / W)
+    pad_x, pad_y = (w - W * gain) / 2, (h - H * gain) / 2
+    top, left = int(round(pad_y - 0.1)), int(round(pad_x - 0.1))
+    bottom, right = h - int(round(pad_y + 0.1)), w - int(round(pad_x + 0.1))
+    return mask[..., top:bottom, left:right]
+
+
+def unletterbox(mask, orig_shape):
+    # undo the letterbox padding of the model input and resize to the original image size
+    mask = crop_letterbox(mask, orig_shape)
+    if mask.ndim == 2:
+        return cv2.resize(mask, (orig_shape[1], orig_shape[0]), interpolation=cv2.INTER_NEAREST)
+    return render(mask, orig_shape)
+
+
+def result_masks(result, mode='union'):
+    if result.masks is None:
+        shape = result.orig_shape if mode != 'stack' else (0,) + tuple(result.orig_shape)
+        return np.zeros(shape, dtype=np.uint16 if mode == 'label' else np.uint8)
+    masks = result.masks.data.cpu().numpy()
+    return unletterbox(combine_masks(masks, mode), result.orig_shape)
+
+
+def output_names(paths):
+    # each input's path below the common directory of all inputs, without extension, so inputs with
+    # the same file name in different directories do not overwrite each other
+    if not paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    names, sources = {}, {}
+    for path in paths:
+        name = os.path.relpath(os.path.splitext(os.path.abspath(path))[0], root)
+        source = sources.setdefault(name, os.path.abspath(path))
+        if source != os.path.abspath(path):
+            raise ValueError('{} and {} would both be written to {}'.format(source, path, name))
+        names[path] = name
+    return names
+
+
+def output_path(name, output_dir, mode, fmt='png'):
+    if fmt in COMPACT_FORMATS:
+        return os.path.join(output_dir, name + COMPACT_FORMATS[fmt][0])
+    return os.path.join(output_dir, name + ('.npz' if mode == 'stack' else '.png'))
+
+
+def save_masks(path, masks, mode):
+    if mode == 'stack':
+        np.savez_compressed(path, masks=masks)
+    else:
+        cv2.imwrite(path, masks)
+
+
+def save_result(path, result, mode='union', fmt='png'):
+    if fmt not in COMPACT_FORMATS:
+        save_masks(path, result_masks(result, mode), mode)
+        return
+    # instance masks stay at model resolution, only the letterbox padding is cut off
+    if result.masks is None:
+        masks, classes = np.zeros((0, 1, 1), dtype=np.uint8), []
+    else:
+        masks = crop_letterbox((result.masks.data > 0.5).cpu().numpy().astype(np.uint8), result.orig_shape)
+        classes = result.boxes.cls.cpu().numpy().astype(int)
+    COMPACT_FORMATS[fmt][1](path, masks, result.orig_shape, classes)
 
-model = YOLO(model_path)
 
-results = model(img)
+def predict(sources, model, output_dir, batch_size=16, mode='union', workers=4, fmt='png', **predict_kwargs):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = collect_inputs(sources)
+    names = output_names(paths)
+    for directory in {os.path.dirname(name) for name in names.values()}:
+        os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+    n_images = 0
+    with ThreadPoolExecutor(max_workers=workers) as writer:
+        writes = deque()
+        for batch in batched(load_images(paths, workers, prefetch=2 * batch_size), batch_size):
+            batch = [(path, img) for path, img in batch if img is not None]
+            if not batch:
+                continue
+            results = model([img for _, img in batch], verbose=False, **predict_kwargs)
+            for (path, _), result in zip(batch, results):
+                writes.append(writer.submit(save_result, output_path(names[path], output_dir, mode, fmt), result, mode, fmt))
+                # full-resolution masks are large, keep only a few waiting to be written
+                while len(writes) > workers:
+                    writes.popleft().result()
+            n_images += len(batch)
+        for write in writes:
+            write.result()
+    return n_images
 
-for result in results:
-    for j, mask in enumerate(result.masks.data):
 
-        mask = mask.numpy() * 255
+def parse_args():
+    parser = argparse.ArgumentParser(description='Segment images with a YOLOv8 segmentation model.')
+    parser.add_argument('sources', nargs='*', default=[image_path], help='image files, directories, glob patterns or .txt file lists')
+    parser.add_argument('--model', default=model_path, help='path to the segmentation weights')
+    parser.add_argument('--output-dir', default='./predictions',
+                        help='one mask file per input image, at its path below the common directory of the inputs')
+    parser.add_argument('--batch-size', type=int, default=16, help='images per model call')
+    parser.add_argument('--imgsz', type=int, default=640, help='inference image size')
+    parser.add_argument('--conf', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--device', default=None, help='inference device, e.g. cpu or 0')
+    parser.add_argument('--mode', choices=['union', 'label', 'stack'], default='union',
+                        help='union: one binary PNG, label: 16-bit PNG of instance ids, stack: .npz with one mask per instance')
+    parser.add_argument('--format', dest='fmt', choices=['png', 'rle', 'packed', 'polygon'], default='png',
+                        help='png: full-resolution masks as set by --mode, rle/packed/polygon: compact per-instance masks '
+                             'at model resolution, read them back with mask_formats.load_masks')
+    parser.add_argument('--workers', type=int, default=4, help='threads for image decoding and mask writing')
+    return parser.parse_args()
 
-        mask = cv2.resize(mask, (W, H))
 
-        cv2.imwrite('./output.png', mask)
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    model = YOLO(args.model)
+    n_images = predict(
+        args.sources, model, args.output_dir, args.batch_size, args.mode, args.workers, args.fmt,
+        imgsz=args.imgsz, conf=args.conf, device=args.device
+    )
+    print('segmented {} images into {}'.format(n_images, args.output_dir))
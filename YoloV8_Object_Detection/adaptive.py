@@ -0,0 +1,229 @@
+import time
+
+import cv2
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+from multi_stream import make_tracker, update_tracks
+
+
+# motion is measured on a small blurred grayscale copy of the frame
+MOTION_WIDTH = 160
+# gray level change that counts a pixel as moving
+MOTION_DELTA = 25
+# propagated tracks narrower or lower than this many pixels have left the frame
+MIN_TRACK_SIZE = 2
+# smaller regions of interest are detected on the full frame instead
+MIN_ROI_SIZE = 32
+
+
+def small_gray(frame):
+    h, w = frame.shape[:2]
+    small = cv2.resize(frame, (MOTION_WIDTH, max(1, round(h * MOTION_WIDTH / w))), interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+
+def box_iou(a, b):
+    # (N, 4) x (M, 4) xyxy boxes -> (N, M)
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def track_data(result):
+    # (N, 7) x1, y1, x2, y2, id, conf, cls of the tracked boxes, none when the tracker returned no tracks
+    if not result.boxes.is_track:
+        return np.zeros((0, 7), dtype=np.float32)
+    return result.boxes.data.cpu().numpy().astype(np.float32)
+
+
+class AdaptiveTracker:
+    """Runs detection only when it is likely to change the tracks.
+
+    A frame is detected when every frames passed since the last detection or when the part of the
+    frame not covered by tracks moved by more than motion_threshold (fraction of pixels) since the
+    last full-frame detection. Other frames get the last tracks moved along their per-frame velocity.
+    With roi set, the periodic detections only look at a crop around the existing tracks, at a
+    proportionally smaller input size, or at the whole frame when the crop would be smaller than
+    MIN_ROI_SIZE. Motion triggered detections always see the whole frame.
+    """
+
+    def __init__(self, model, tracker='botsort.yaml', every=5, motion_threshold=0.01, roi=False, roi_margin=0.5,
+                 imgsz=640, **predict_kwargs):
+        self.model = model
+        self.tracker = make_tracker(tracker)
+        self.every = every
+        self.motion_threshold = motion_threshold
+        self.roi = roi
+        self.roi_margin = roi_margin
+        self.imgsz = imgsz
+        # model.track predicts at conf 0.1 so the second association sees the low score detections
+        predict_kwargs['conf'] = 0.1 if predict_kwargs.get('conf') is None else predict_kwargs['conf']
+        self.predict_kwargs = predict_kwargs
+        self.frame_index = -1
+        self.detected_at = None
+        # tracks of the last frame as (N, 7) x1, y1, x2, y2, id, conf, cls and their (N, 4) velocity per frame
+        self.tracks = np.zeros((0, 7), dtype=np.float32)
+        self.velocity = np.zeros((0, 4), dtype=np.float32)
+        # tracks as detected, velocities are measured between two detections
+        self.detected = self.tracks
+        self.reference = None
+        self.reference_boxes = np.zeros((0, 4), dtype=np.float32)
+        self.confirm = False
+        self.counts = {'frames': 0, 'full': 0, 'roi': 0, 'propagated': 0, 'motion': 0}
+
+    def motion(self, gray, frame_shape):
+        # changed pixels outside the current and the reference tracks, the tracker follows those
+        moving = cv2.absdiff(gray, self.reference) > MOTION_DELTA
+        scale = gray.shape[1] / frame_shape[1]
+        for x1, y1, x2, y2 in np.concatenate((self.tracks[:, :4], self.reference_boxes)) * scale:
+            moving[int(y1):int(np.ceil(y2)), int(x1):int(np.ceil(x2))] = False
+        return moving.mean()
+
+    def roi_box(self, frame_shape):
+        # union of the tracks grown by roi_margin of their size on every side, None when it is too small to detect on
+        h, w = frame_shape[:2]
+        boxes = self.tracks[:, :4]
+        size = boxes[:, 2:] - boxes[:, :2]
+        lo = (boxes[:, :2] - size * self.roi_margin).min(axis=0)
+        hi = (boxes[:, 2:] + size * self.roi_margin).max(axis=0)
+        x1, y1 = max(0, int(lo[0])), max(0, int(lo[1]))
+        x2, y2 = min(w, int(np.ceil(hi[0]))), min(h, int(np.ceil(hi[1])))
+        if x2 - x1 < MIN_ROI_SIZE or y2 - y1 < MIN_ROI_SIZE:
+            return None
+        return x1, y1, x2, y2
+
+    def detect(self, frame, box=None):
+        if box is None:
+            return self.model.predict(frame, imgsz=self.imgsz, verbose=False, **self.predict_kwargs)[0]
+        x1, y1, x2, y2 = box
+        crop = frame[y1:y2, x1:x2]
+        # keep the pixels per object of a full-frame detection, a smaller crop costs less
+        imgsz = self.imgsz * max(crop.shape[:2]) / max(frame.shape[:2])
+        imgsz = max(64, int(np.ceil(imgsz / 32)) * 32)
+        result = self.model.predict(crop, imgsz=imgsz, verbose=False, **self.predict_kwargs)[0]
+        data = result.boxes.data.clone()
+        data[:, [0, 2]] += x1
+        data[:, [1, 3]] += y1
+        return Results(frame, path=result.path, names=result.names, boxes=data)
+
+    def propagate(self, frame):
+        h, w = frame.shape[:2]
+        self.tracks[:, :4] += self.velocity
+        self.tracks[:, [0, 2]] = self.tracks[:, [0, 2]].clip(0, w)
+        self.tracks[:, [1, 3]] = self.tracks[:, [1, 3]].clip(0, h)
+        # tracks moved out of the frame are clipped to nothing, drop them
+        size = self.tracks[:, 2:4] - self.tracks[:, :2]
+        inside = (size >= MIN_TRACK_SIZE).all(axis=1)
+        self.tracks, self.velocity = self.tracks[inside], self.velocity[inside]
+        return Results(frame, path='', names=self.model.names, boxes=torch.as_tensor(self.tracks))
+
+    def update(self, result):
+        tracks = track_data(result)
+        velocity = np.zeros((len(tracks), 4), dtype=np.float32)
+        if self.detected_at is not None:
+            gap = self.frame_index - self.detected_at
+            # velocity from the last detection, the propagated boxes would only echo the old velocity
+            previous = {int(t[4]): t[:4] for t in self.detected}
+            for i, t in enumerate(tracks):
+                if int(t[4]) in previous:
+                    velocity[i] = (t[:4] - previous[int(t[4])]) / gap
+        self.tracks, self.velocity = tracks, velocity
+        self.detected = tracks.copy()
+        self.detected_at = self.frame_index
+
+    def __call__(self, frame):
+        self.frame_index += 1
+        self.counts['frames'] += 1
+        gray = small_gray(frame)
+        moved = self.reference is not None and self.motion_threshold is not None \
+            and self.motion(gray, frame.shape) > self.motion_threshold
+        # a new object needs a second detection before the tracker confirms it
+        full = moved or self.confirm
+        self.confirm = moved
+        periodic = self.detected_at is None or self.frame_index - self.detected_at >= self.every
+        if not full and not periodic:
+            self.counts['propagated'] += 1
+            return self.propagate(frame)
+
+        if moved:
+            self.counts['motion'] += 1
+        box = self.roi_box(frame.shape) if self.roi and not full and len(self.tracks) else None
+        result = update_tracks(self.tracker, self.detect(frame, box))
+        self.update(result)
+        if box is None:
+            self.counts['full'] += 1
+            self.reference = gray
+            self.reference_boxes = self.tracks[:, :4].copy()
+        else:
+            self.counts['roi'] += 1
+        return result
+
+
+def run_adaptive(model, cap, sink, max_frames=None, **adaptive_kwargs):
+    # returns the tracks of every frame as (N, 7) arrays and the timing of the detect/propagate loop
+    tracker = AdaptiveTracker(model, **adaptive_kwargs)
+    frames, busy = [], 0.0
+    while max_frames is None or len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        result = tracker(frame)
+        busy += time.perf_counter() - start
+        frames.append(track_data(result))
+        if sink is not None and not sink(result):
+            break
+    return frames, dict(tracker.counts, seconds=busy, fps=len(frames) / busy if busy else 0.0)
+
+
+def match_tracks(reference, frames, iou_threshold=0.5):
+    # greedy class-agnostic matching of the boxes of every frame against the reference run
+    matched = total_reference = total = 0
+    ious = []
+    for ref, boxes in zip(reference, frames):
+        total_reference += len(ref)
+        total += len(boxes)
+        if not len(ref) or not len(boxes):
+            continue
+        iou = box_iou(ref[:, :4], boxes[:, :4])
+        while iou.size and iou.max() >= iou_threshold:
+            i, j = np.unravel_index(iou.argmax(), iou.shape)
+            ious.append(iou[i, j])
+            matched += 1
+            iou[i, :] = 0
+            iou[:, j] = 0
+    return {
+        'recall': matched / total_reference if total_reference else 1.0,
+        'precision': matched / total if total else 1.0,
+        'mean_iou': float(np.mean(ious)) if ious else 0.0
+    }
+
+
+def compare(model, video, max_frames=None, tracker='botsort.yaml', imgsz=640, **adaptive_kwargs):
+    """Accuracy and speed of the adaptive mode against detecting every frame.
+
+    Both runs use the same model, tracker config and input size. Accuracy is the recall, precision
+    and mean IoU of the adaptive boxes matched to the every-frame boxes at IoU 0.5.
+    """
+    predict_kwargs = {k: adaptive_kwargs.pop(k) for k in ('device', 'conf') if k in adaptive_kwargs}
+    # the first call sets the predictor up, keep it out of both timings
+    model.predict(np.zeros((64, 64, 3), dtype=np.uint8), imgsz=imgsz, verbose=False, **predict_kwargs)
+    runs = {}
+    for name, kwargs in (('baseline', dict(every=1, motion_threshold=None, roi=False)), ('adaptive', adaptive_kwargs)):
+        cap = cv2.VideoCapture(video)
+        try:
+            runs[name] = run_adaptive(model, cap, None, max_frames, tracker=tracker, imgsz=imgsz, **kwargs, **predict_kwargs)
+        finally:
+            cap.release()
+    (reference, baseline), (frames, adaptive) = runs['baseline'], runs['adaptive']
+    return {
+        'baseline': baseline,
+        'adaptive': adaptive,
+        'speedup': adaptive['fps'] / baseline['fps'] if baseline['fps'] else 0.0,
+        'accuracy': match_tracks(reference, frames)
+    }
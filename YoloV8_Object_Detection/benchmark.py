@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+import ultralytics
+from ultralytics import YOLO
+
+from main import Output, StageStats, VideoSink, run_pipelined, run_serial
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+MODES = ['serial', 'pipelined', 'adaptive', 'adaptive-roi', 'multi']
+
+
+def peak_rss_mb():
+    # peak of the whole process, meaningful because every mode runs in a process of its own
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if platform.system() == 'Darwin' else peak / 2**10
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_video(path, width=1280, height=720, frames=300, objects=8, fps=30, seed=0):
+    """Write a synthetic video of shapes moving over a static textured background.
+
+    The shapes bounce off the borders at constant speed, the same arguments always give the same video.
+    """
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    background = np.stack([xx * 80 // width + 40, yy * 80 // height + 40, np.full_like(xx, 60)], axis=-1).astype(np.uint8)
+    background = cv2.add(background, rng.randint(0, 12, background.shape, dtype=np.uint8))
+    scale = min(width, height)
+    size = rng.uniform(0.05, 0.2, (objects, 2)) * scale
+    pos = rng.uniform(0, 1, (objects, 2)) * ([width, height] - size)
+    speed = rng.uniform(-0.01, 0.01, (objects, 2)) * scale
+    colors = rng.randint(0, 256, (objects, 3))
+    kinds = rng.randint(0, 2, objects)
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError('could not open video writer for {}'.format(path))
+    for _ in range(frames):
+        frame = background.copy()
+        for (x, y), (w, h), color, kind in zip(pos.astype(int), size.astype(int), colors.tolist(), kinds):
+            if kind:
+                cv2.ellipse(frame, (x + w // 2, y + h // 2), (w // 2, h // 2), 0, 0, 360, color, -1)
+            else:
+                cv2.rectangle(frame, (x, y), (x + w, y + h), color, -1)
+        writer.write(frame)
+        pos += speed
+        bounce = (pos < 0) | (pos > [width, height] - size)
+        speed[bounce] *= -1
+        pos = np.clip(pos, 0, [width, height] - size)
+    writer.release()
+    return path
+
+
+def video_path(args):
+    name = 'synthetic_{}x{}_{}f_{}o_s{}.mp4'.format(args.width, args.height, args.frames, args.objects, args.seed)
+    path = os.path.join(args.video_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(args.video_dir, exist_ok=True)
+        make_video(path, args.width, args.height, args.frames, args.objects, seed=args.seed)
+    return path
+
+
+def load_model(args):
+    # a fresh model per run, model.track keeps its tracker on the predictor
+    if not args.model.endswith('.yaml') and not os.path.exists(args.model):
+        raise SystemExit('{} not found, the benchmark runs offline: pass a local .pt file, '
+                         'or a .yaml such as yolov8n.yaml for an untrained model of the same cost'.format(args.model))
+    model = YOLO(args.model)
+    # the first call sets the predictor up, keep it out of the timings
+    model.predict(np.zeros((args.height, args.width, 3), dtype=np.uint8), imgsz=args.imgsz, device=args.device, verbose=False)
+    return model
+
+
+def make_output(args, tmp, name):
+    sinks = [VideoSink(os.path.join(tmp, name + '.mp4'))] if args.encode else []
+    return Output(sinks, draw=not args.no_draw)
+
+
+def summarize(stats, start, end):
+    frames = stats['render'].frames
+    summary = {name: s.summary() for name, s in stats.items()}
+    render = summary['render']
+    return {
+        'frames': frames,
+        'fps': frames / (end - start),
+        'decode_fps': summary['decode']['busy_fps'],
+        'infer_fps': summary['track']['busy_fps'],
+        'render_fps': summary['render']['busy_fps'],
+        'latency_p50_ms': render.get('latency_p50_ms'),
+        'latency_p95_ms': render.get('latency_p95_ms'),
+        'latency_p99_ms': render.get('latency_p99_ms'),
+        'stages': summary
+    }
+
+
+def run_adaptive_stats(model, cap, output, **adaptive_kwargs):
+    # same stages as the serial loop, track is the detect-or-propagate step
+    from adaptive import AdaptiveTracker
+
+    tracker = AdaptiveTracker(model, **adaptive_kwargs)
+    stats = {name: StageStats(name) for name in ('decode', 'track', 'render')}
+    while True:
+        stamp = time.perf_counter()
+        ret, frame = cap.read()
+        if not ret:
+            break
+        stats['decode'].add(time.perf_counter() - stamp)
+        start = time.perf_counter()
+        result = tracker(frame)
+        stats['track'].add(time.perf_counter() - start)
+        start = time.perf_counter()
+        output(result)
+        end = time.perf_counter()
+        stats['render'].add(end - start, latency=end - stamp)
+    for s in stats.values():
+        s.finish()
+    return stats, tracker.counts
+
+
+def run_multi(model, args, path):
+    from multi_stream import MultiStreamTracker
+
+    server = MultiStreamTracker(model, [path] * args.streams, args.tracker, args.max_batch, drop=False,
+                                imgsz=args.imgsz, device=args.device)
+    outputs = [Output([], draw=not args.no_draw) for _ in range(args.streams)]
+    start = time.perf_counter()
+    server.run(outputs)
+    end = time.perf_counter()
+    summary = server.summary()
+    frames = sum(s['tracked'] for s in summary['streams'])
+    return {
+        'frames': frames,
+        'fps': frames / (end - start),
+        'streams': args.streams,
+        'mean_batch': summary['mean_batch'],
+        'latency_p50_ms': float(np.median([s['latency_p50_ms'] for s in summary['streams']])),
+        'latency_p95_ms': float(max(s['latency_p95_ms'] for s in summary['streams'])),
+        'per_stream': summary['streams']
+    }
+
+
+def run_mode(mode, args, path, tmp):
+    model = load_model(args)
+    if mode == 'multi':
+        row = run_multi(model, args, path)
+    else:
+        cap = cv2.VideoCapture(path)
+        output = make_output(args, tmp, mode)
+        track_kwargs = dict(imgsz=args.imgsz, device=args.device, tracker=args.tracker)
+        try:
+            start = time.perf_counter()
+            if mode == 'serial':
+                stats = run_serial(model, cap, output, **track_kwargs)
+            elif mode == 'pipelined':
+                stats = run_pipelined(model, cap, output, args.queue_size, **track_kwargs)
+            else:
+                stats, counts = run_adaptive_stats(
+                    model, cap, output, every=args.detect_every, roi=mode == 'adaptive-roi', **track_kwargs
+                )
+            end = time.perf_counter()
+        finally:
+            cap.release()
+            output.close()
+        row = summarize(stats, start, end)
+        if mode.startswith('adaptive'):
+            row['detections'] = counts
+    row['mode'] = mode
+    row['peak_rss_mb'] = peak_rss_mb()
+    return row
+
+
+def run_mode_process(mode):
+    # the same command line with --mode, the child prints its row as the last line of its output
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--mode', mode, '--output', '']
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def mode_main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(json.dumps(run_mode(args.mode, args, video_path(args), tmp)))
+
+
+def main(args):
+    path = video_path(args)
+    results = []
+    for mode in args.modes:
+        # a fresh process per mode, ru_maxrss never goes down so a shared process
+        # would report the highest peak so far instead of the mode's own
+        row = run_mode_process(mode)
+        results.append(row)
+        print('{:<13} {:8.1f} fps  decode {:8.1f}  infer {:7.1f}  render {:8.1f}  p50 {:7.1f}ms  p95 {:7.1f}ms  rss {:.0f}MB'.format(
+            mode, row['fps'], row.get('decode_fps', 0), row.get('infer_fps', 0), row.get('render_fps', 0),
+            row['latency_p50_ms'] or 0, row['latency_p95_ms'] or 0, row['peak_rss_mb'] or 0
+        ))
+    report = {
+        'commit': git_commit(),
+        'ultralytics': ultralytics.__version__,
+        'torch': torch.__version__,
+        'opencv': cv2.__version__,
+        'cpu': platform.processor() or platform.machine(),
+        'threads': torch.get_num_threads(),
+        'video': os.path.basename(path),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'video_dir', 'mode')},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the tracking loops on synthetic video.')
+    parser.add_argument('--model', default='yolov8n.pt', help='local weights, or a .yaml for an untrained model')
+    parser.add_argument('--tracker', default='botsort.yaml', help='tracker config')
+    parser.add_argument('--device', default='cpu', help='inference device')
+    parser.add_argument('--imgsz', type=int, default=640, help='inference image size')
+    # synthetic video, cached in video-dir by its parameters
+    parser.add_argument('--video-dir', default='./bench_videos', help='where the synthetic videos are written')
+    parser.add_argument('--width', type=int, default=1280, help='video width')
+    parser.add_argument('--height', type=int, default=720, help='video height')
+    parser.add_argument('--frames', type=int, default=300, help='video length in frames')
+    parser.add_argument('--objects', type=int, default=8, help='moving shapes per frame')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the video')
+    # modes
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES, help='loops to run')
+    parser.add_argument('--queue-size', type=int, default=8, help='pipelined queue size')
+    parser.add_argument('--detect-every', type=int, default=5, help='adaptive detection interval')
+    parser.add_argument('--streams', type=int, default=4, help='copies of the video in the multi mode')
+    parser.add_argument('--max-batch', type=int, default=16, help='multi mode batch size')
+    parser.add_argument('--no-draw', action='store_true', help='skip plotting the results')
+    parser.add_argument('--encode', action='store_true', help='also encode the annotated video')
+    # output
+    parser.add_argument('--output', default='benchmark.json', help='JSON report, compare these across commits')
+    # internal, runs one mode and prints its row
+    parser.add_argument('--mode', choices=MODES, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.no_draw and args.encode:
+        parser.error('--no-draw leaves nothing to write with --encode')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode is None:
+        main(args)
+    else:
+        mode_main(args)
@@ -1,29 +1,412 @@
+import argparse
+import csv
+import json
+import queue
+import threading
+import time
+
 from ultralytics import YOLO
 import cv2
+import numpy as np
+
+
+class StageStats:
+    # frames handled, time spent working and input queue depth of one stage,
+    # the last stage also records the end-to-end latency from the start of the decode
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.latencies = []
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, seconds, depth=0, latency=None):
+        self.frames += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        self.busy += seconds
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def summary(self):
+        wall = (self.end or time.perf_counter()) - self.start
+        summary = {
+            'stage': self.name,
+            'frames': self.frames,
+            'fps': self.frames / wall if wall else 0.0,
+            # throughput the stage would reach if it never waited on its neighbours
+            'busy_fps': self.frames / self.busy if self.busy else 0.0,
+            'utilization': self.busy / wall if wall else 0.0,
+            'queue_mean': self.depth_sum / self.frames if self.frames else 0.0,
+            'queue_max': self.depth_max
+        }
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            summary.update(
+                latency_p50_ms=float(np.percentile(latencies, 50)),
+                latency_p95_ms=float(np.percentile(latencies, 95)),
+                latency_p99_ms=float(np.percentile(latencies, 99))
+            )
+        return summary
+
+
+def print_stats(stats):
+    for s in (s.summary() for s in stats.values()):
+        print('{stage:<8} {frames:6d} frames {fps:8.1f} fps  busy {busy_fps:8.1f} fps  '
+              'util {utilization:5.0%}  queue mean {queue_mean:4.1f} max {queue_max}'.format(**s))
+        if 'latency_p50_ms' in s:
+            print('{:<8} latency p50 {latency_p50_ms:.1f}ms p95 {latency_p95_ms:.1f}ms p99 {latency_p99_ms:.1f}ms'.format('', **s))
+
+
+class Display:
+    # shows the annotated frames, returns False once 'q' is pressed
+    def __init__(self, wait=25, name='frame'):
+        self.wait = wait
+        self.name = name
+
+    def __call__(self, result, frame):
+        cv2.imshow(self.name, frame)
+        return not (cv2.waitKey(self.wait) & 0xFF == ord('q'))
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+
+class VideoSink:
+    # writes the annotated frames, the writer is opened once the frame size is known
+    def __init__(self, path, fps=25.0, fourcc='mp4v'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.writer = None
+
+    def __call__(self, result, frame):
+        if self.writer is None:
+            h, w = frame.shape[:2]
+            self.writer = cv2.VideoWriter(self.path, self.fourcc, self.fps, (w, h))
+            if not self.writer.isOpened():
+                raise IOError('could not open video writer for {}'.format(self.path))
+        self.writer.write(frame)
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+def track_records(result):
+    # one record per box: track id (None until the tracker confirms it), class, xyxy box in pixels and confidence
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return []
+    ids = boxes.id.int().tolist() if boxes.id is not None else [None] * len(boxes)
+    return [
+        {
+            'track_id': track_id,
+            'class': int(c),
+            'name': result.names[int(c)],
+            'box': [round(v, 2) for v in box],
+            'conf': round(conf, 4)
+        }
+        for track_id, c, box, conf in zip(ids, boxes.cls.tolist(), boxes.xyxy.tolist(), boxes.conf.tolist())
+    ]
+
+
+class TrackLog:
+    """Streams the tracks of every frame to a .jsonl or .csv file.
+
+    JSON lines hold one frame each, {"frame": i, "tracks": [...]}, frames without tracks included.
+    CSV has one row per track with the box split into x1, y1, x2, y2.
+    """
+    CSV_FIELDS = ['frame', 'track_id', 'class', 'name', 'x1', 'y1', 'x2', 'y2', 'conf']
+
+    def __init__(self, path):
+        self.csv = path.lower().endswith('.csv')
+        self.file = open(path, 'w', newline='' if self.csv else None)
+        if self.csv:
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.CSV_FIELDS)
+        self.frame = 0
+
+    def __call__(self, result, frame):
+        records = track_records(result)
+        if self.csv:
+            self.writer.writerows(
+                [self.frame, r['track_id'], r['class'], r['name']] + r['box'] + [r['conf']] for r in records
+            )
+        else:
+            self.file.write(json.dumps({'frame': self.frame, 'tracks': records}) + '\n')
+        self.frame += 1
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+class Output:
+    # draws each result at most once and hands it to every sink, returns False once a sink asks to stop
+    def __init__(self, sinks, draw=True):
+        self.sinks = sinks
+        self.draw = draw
+
+    def __call__(self, result):
+        frame = result.plot() if self.draw else None
+        keep = [sink(result, frame) for sink in self.sinks]
+        return all(keep)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def track(model, frame, **track_kwargs):
+    # detect objects
+    # track objects
+    return model.track(frame, persist=True, verbose=False, **track_kwargs)[0]
+
+
+def run_serial(model, cap, sink, **track_kwargs):
+    stats = {name: StageStats(name) for name in ('decode', 'track', 'render')}
+    while True:
+        stamp = start = time.perf_counter()
+        ret, frame = cap.read() #returns new frame from video
+        if not ret:
+            break
+        stats['decode'].add(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        result = track(model, frame, **track_kwargs)
+        stats['track'].add(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        keep = sink(result)
+        end = time.perf_counter()
+        stats['render'].add(end - start, latency=end - stamp)
+        if not keep:
+            break
+    for s in stats.values():
+        s.finish()
+    return stats
+
+
+def _put(q, item, stop):
+    # blocks while the queue is full, gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def run_pipelined(model, cap, sink, queue_size=8, **track_kwargs):
+    """Decode, track and render on separate threads joined by bounded queues.
+
+    Every stage is a single thread reading a FIFO queue, so the tracker and the sink see the
+    frames in video order. The sink runs on the calling thread, imshow has to stay there.
+    """
+    decoded, tracked = queue.Queue(queue_size), queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+    stats = {name: StageStats(name) for name in ('decode', 'track', 'render')}
+
+    def decode():
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                stats['decode'].add(time.perf_counter() - start)
+                if not _put(decoded, (start, frame), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        stats['decode'].finish()
+        _put(decoded, None, stop)
+
+    def track_frames():
+        try:
+            while True:
+                depth = decoded.qsize()
+                item = _get(decoded, stop)
+                if item is None:
+                    break
+                stamp, frame = item
+                start = time.perf_counter()
+                result = track(model, frame, **track_kwargs)
+                stats['track'].add(time.perf_counter() - start, depth)
+                if not _put(tracked, (stamp, result), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        stats['track'].finish()
+        _put(tracked, None, stop)
+
+    threads = [threading.Thread(target=decode, daemon=True), threading.Thread(target=track_frames, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            depth = tracked.qsize()
+            item = _get(tracked, stop)
+            if item is None:
+                break
+            stamp, result = item
+            start = time.perf_counter()
+            keep = sink(result)
+            end = time.perf_counter()
+            stats['render'].add(end - start, depth, end - stamp)
+            if not keep:
+                break
+    finally:
+        stats['render'].finish()
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def make_output(args, fps, stream=None):
+    # with several streams the output paths hold a {} that is replaced by the stream index
+    name = lambda path: path if stream is None else path.format(stream)
+    sinks = []
+    if not args.headless:
+        sinks.append(Display(args.wait, 'frame' if stream is None else 'stream {}'.format(stream)))
+    if args.output:
+        sinks.append(VideoSink(name(args.output), fps))
+    if args.log:
+        sinks.append(TrackLog(name(args.log)))
+    return Output(sinks, draw=not args.no_draw)
+
+
+def run_streams(model, args):
+    from multi_stream import MultiStreamTracker
+
+    server = MultiStreamTracker(
+        model, args.videos, args.tracker, args.max_batch, args.max_buffer, args.max_latency, args.drop,
+        device=args.device
+    )
+    outputs = [make_output(args, stream.fps, stream.index) for stream in server.streams]
+    try:
+        server.run(outputs)
+    finally:
+        for output in outputs:
+            output.close()
+    summary = server.summary()
+    print('{batches} batches, {mean_batch:.1f} frames per model call'.format(**summary))
+    for s in summary['streams']:
+        print('stream {stream:<3} {read:6d} read {tracked:6d} tracked {dropped:6d} dropped  latency p50 '
+              '{latency_p50_ms:7.1f}ms p95 {latency_p95_ms:7.1f}ms max {latency_max_ms:7.1f}ms  {source}'.format(**s))
+
 
+def run_adaptive(model, args):
+    import adaptive
 
-# load yolov8 model
-model = YOLO('yolov8n.pt')
+    kwargs = dict(
+        tracker=args.tracker, every=args.detect_every, roi=args.roi, roi_margin=args.roi_margin,
+        motion_threshold=args.motion_threshold if args.motion_threshold > 0 else None, device=args.device
+    )
+    if args.compare:
+        report = adaptive.compare(model, args.videos[0], **kwargs)
+        print(json.dumps(report, indent=2))
+        return
+    cap = cv2.VideoCapture(args.videos[0])
+    output = make_output(args, cap.get(cv2.CAP_PROP_FPS) or 25.0)
+    try:
+        _, counts = adaptive.run_adaptive(model, cap, output, **kwargs)
+    finally:
+        cap.release()
+        output.close()
+    print('{frames} frames {fps:.1f} fps: {full} full detections ({motion} on motion), {roi} roi detections, '
+          '{propagated} propagated'.format(**counts))
 
-# load video
-video_path = './test1.mp4'
-cap = cv2.VideoCapture(video_path) 
 
-ret = True
-# read frames
-while ret:
-    ret, frame = cap.read() #returns new frame from video
+def parse_args():
+    parser = argparse.ArgumentParser(description='Track objects in a video with YOLOv8.')
+    parser.add_argument('videos', nargs='*', default=['./test1.mp4'],
+                        help='video files, stream urls or webcam indices, several sources run as a multi-stream server')
+    parser.add_argument('--model', default='yolov8n.pt', help='detection weights')
+    parser.add_argument('--tracker', default='botsort.yaml', help='tracker config, botsort.yaml or bytetrack.yaml')
+    parser.add_argument('--pipelined', action='store_true', help='decode, track and render on separate threads')
+    parser.add_argument('--queue-size', type=int, default=8, help='frames buffered between pipeline stages')
+    parser.add_argument('--wait', type=int, default=25, help='waitKey delay of the display in ms')
+    parser.add_argument('--device', default=None, help='inference device, e.g. cpu or 0')
+    # headless output
+    parser.add_argument('--headless', action='store_true', help='no display window, for servers without a screen')
+    parser.add_argument('--output', default=None, help='write the annotated video here')
+    parser.add_argument('--log', default=None, help='write the tracks of every frame to a .jsonl or .csv file')
+    parser.add_argument('--no-draw', action='store_true', help='skip drawing, only the track log is written, implies --headless')
+    # multi-stream
+    parser.add_argument('--max-batch', type=int, default=16, help='most frames per model call across streams')
+    parser.add_argument('--max-buffer', type=int, default=4, help='frames buffered per stream')
+    parser.add_argument('--max-latency', type=float, default=None,
+                        help='seconds, older frames of dropping streams are skipped instead of tracked')
+    parser.add_argument('--drop', dest='drop', action='store_const', const=True, default=None,
+                        help='drop frames of every stream that falls behind, by default only live streams drop')
+    parser.add_argument('--no-drop', dest='drop', action='store_const', const=False, help='never drop frames')
+    # adaptive detection
+    parser.add_argument('--adaptive', action='store_true', help='detect every few frames or on motion, propagate tracks in between')
+    parser.add_argument('--detect-every', type=int, default=5, help='frames between periodic detections')
+    parser.add_argument('--motion-threshold', type=float, default=0.01,
+                        help='fraction of changed pixels away from the tracks that triggers a full detection, 0 disables')
+    parser.add_argument('--roi', action='store_true', help='periodic detections only look at a crop around the tracks')
+    parser.add_argument('--roi-margin', type=float, default=0.5, help='crop margin around the tracks, relative to their size')
+    parser.add_argument('--compare', action='store_true', help='report accuracy and fps of --adaptive against detecting every frame')
+    args = parser.parse_args()
+    if args.compare:
+        args.adaptive = True
+    if args.no_draw:
+        if args.output:
+            parser.error('--no-draw leaves nothing to write to --output')
+        args.headless = True
+    if len(args.videos) > 1:
+        for path in (args.output, args.log):
+            if path and '{}' not in path:
+                parser.error('with several videos --output and --log need a {} for the stream index')
+    return args
 
-    if ret:
 
-        # detect objects
-        # track objects
-        results = model.track(frame, persist=True)
+if __name__ == '__main__':
+    args = parse_args()
 
-        # plot results
-        frame_ = results[0].plot()
+    # load yolov8 model
+    model = YOLO(args.model)
 
-        # visualize
-        cv2.imshow('frame', frame_)
-        if cv2.waitKey(25) & 0xFF == ord('q'):
-            break
\ No newline at end of file
+    if len(args.videos) > 1:
+        run_streams(model, args)
+    elif args.adaptive:
+        run_adaptive(model, args)
+    else:
+        # load video
+        cap = cv2.VideoCapture(args.videos[0])
+        output = make_output(args, cap.get(cv2.CAP_PROP_FPS) or 25.0)
+        try:
+            if args.pipelined:
+                stats = run_pipelined(model, cap, output, args.queue_size, device=args.device, tracker=args.tracker)
+            else:
+                stats = run_serial(model, cap, output, device=args.device, tracker=args.tracker)
+        finally:
+            cap.release()
+            output.close()
+        print_stats(stats)
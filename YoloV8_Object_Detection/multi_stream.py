@@ -0,0 +1,216 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from ultralytics.trackers import BOTSORT, BYTETracker
+from ultralytics.utils import IterableSimpleNamespace
+from ultralytics.utils.checks import check_yaml
+
+
+TRACKERS = {'bytetrack': BYTETracker, 'botsort': BOTSORT}
+
+
+def make_tracker(config='botsort.yaml'):
+    # same configs as model.track(tracker=...), one tracker per stream keeps the track ids apart
+    with open(check_yaml(config)) as f:
+        cfg = IterableSimpleNamespace(**yaml.safe_load(f))
+    if cfg.tracker_type not in TRACKERS:
+        raise ValueError('only {} are supported, got {}'.format(sorted(TRACKERS), cfg.tracker_type))
+    return TRACKERS[cfg.tracker_type](args=cfg)
+
+
+def update_tracks(tracker, result):
+    # same as the tracking callback of YOLOv8's model.track: keep the tracked boxes and attach their ids.
+    # A frame without detections skips the tracker and a frame without tracks keeps its untracked detections,
+    # so the boxes of the result have ids only when boxes.is_track is set
+    det = result.boxes.cpu().numpy()
+    if len(det) == 0:
+        return result
+    tracks = tracker.update(det, result.orig_img)
+    if len(tracks) == 0:
+        return result
+    result = result[tracks[:, -1].astype(int)]
+    result.update(boxes=torch.as_tensor(tracks[:, :-1], device=result.boxes.data.device))
+    return result
+
+
+def is_live(source):
+    # webcams and network streams keep producing frames whether we keep up or not
+    return source.isdigit() or '://' in source
+
+
+class Stream:
+    """One video source decoded on its own thread into a small buffer.
+
+    Live sources drop the oldest buffered frame when the buffer is full and frames older than
+    max_latency seconds are dropped instead of tracked, so a slow node never falls further behind
+    than max_buffer frames or max_latency seconds. Files are read at the speed of the tracker and
+    lose no frames unless drop is set.
+    """
+
+    def __init__(self, index, source, ready, max_buffer=4, max_latency=None, drop=None):
+        self.index = index
+        self.source = source
+        self.max_buffer = max_buffer
+        self.drop = is_live(source) if drop is None else drop
+        self.max_latency = max_latency if self.drop else None
+        self.cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        if not self.cap.isOpened():
+            raise IOError('could not open {}'.format(source))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 25.0
+        self.tracker = None
+        # ready is shared by all streams and wakes the batcher when a frame arrives
+        self.ready = ready
+        self.buffer = deque()
+        self.space = threading.Condition(threading.Lock())
+        self.finished = False
+        self.closed = False
+        self.read = 0
+        self.dropped = 0
+        self.tracked = 0
+        # latency of the most recent frames
+        self.latencies = deque(maxlen=10000)
+        self.thread = threading.Thread(target=self._read, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _read(self):
+        index = 0
+        while not self.closed:
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            with self.space:
+                while len(self.buffer) >= self.max_buffer and not self.drop and not self.closed:
+                    self.space.wait(0.1)
+                if len(self.buffer) >= self.max_buffer:
+                    self.buffer.popleft()
+                    self.dropped += 1
+                self.buffer.append((index, time.perf_counter(), frame))
+                self.read += 1
+            index += 1
+            with self.ready:
+                self.ready.notify()
+        self.finished = True
+        with self.ready:
+            self.ready.notify()
+
+    def take(self, now):
+        # oldest frame still inside the latency bound, None if there is none
+        with self.space:
+            while self.buffer:
+                index, stamp, frame = self.buffer.popleft()
+                self.space.notify()
+                if self.max_latency is not None and now - stamp > self.max_latency:
+                    self.dropped += 1
+                    continue
+                return index, stamp, frame
+        return None
+
+    @property
+    def done(self):
+        return self.finished and not self.buffer
+
+    def close(self):
+        self.closed = True
+        if self.thread.is_alive():
+            self.thread.join()
+        self.cap.release()
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            'stream': self.index,
+            'source': self.source,
+            'read': self.read,
+            'tracked': self.tracked,
+            'dropped': self.dropped,
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p95_ms': float(np.percentile(latencies, 95)),
+            'latency_max_ms': float(latencies.max())
+        }
+
+
+class MultiStreamTracker:
+    """Tracks many video sources with one shared model.
+
+    Every model call batches the oldest pending frame of up to max_batch streams, round robin, so
+    each stream advances one frame per call in its own order and keeps its own tracker state.
+    Results go to sinks[i](result) for stream i, a sink returning False stops all streams.
+    """
+
+    def __init__(self, model, sources, tracker='botsort.yaml', max_batch=16, max_buffer=4, max_latency=None,
+                 drop=None, **predict_kwargs):
+        self.model = model
+        self.max_batch = max_batch
+        # model.track predicts at conf 0.1 so the second association sees the low score detections
+        predict_kwargs['conf'] = 0.1 if predict_kwargs.get('conf') is None else predict_kwargs['conf']
+        self.predict_kwargs = predict_kwargs
+        self.ready = threading.Condition()
+        self.streams = [Stream(i, source, self.ready, max_buffer, max_latency, drop) for i, source in enumerate(sources)]
+        for stream in self.streams:
+            stream.tracker = make_tracker(tracker)
+        self.next = 0
+        self.batches = 0
+        self.batch_frames = 0
+
+    def _batch(self):
+        now = time.perf_counter()
+        n = len(self.streams)
+        batch = []
+        for i in range(n):
+            stream = self.streams[(self.next + i) % n]
+            frame = stream.take(now)
+            if frame is not None:
+                batch.append((stream, frame))
+                if len(batch) == self.max_batch:
+                    break
+        # the next batch starts after the last stream served, no stream waits behind the others
+        if batch:
+            self.next = (batch[-1][0].index + 1) % n
+        return batch
+
+    def warmup(self):
+        # the first model call sets the predictor up, keep it out of the latency of the first frames
+        cap = self.streams[0].cap
+        h, w = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 640, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or 640
+        self.model.predict(np.zeros((h, w, 3), dtype=np.uint8), verbose=False, **self.predict_kwargs)
+
+    def run(self, sinks):
+        self.warmup()
+        for stream in self.streams:
+            stream.start()
+        try:
+            while True:
+                batch = self._batch()
+                if not batch:
+                    if all(stream.done for stream in self.streams):
+                        break
+                    with self.ready:
+                        self.ready.wait(0.01)
+                    continue
+                results = self.model.predict([frame for _, (_, _, frame) in batch], verbose=False, **self.predict_kwargs)
+                self.batches += 1
+                self.batch_frames += len(batch)
+                for (stream, (index, stamp, _)), result in zip(batch, results):
+                    result = update_tracks(stream.tracker, result)
+                    keep = sinks[stream.index](result)
+                    stream.tracked += 1
+                    stream.latencies.append(time.perf_counter() - stamp)
+                    if not keep:
+                        return
+        finally:
+            for stream in self.streams:
+                stream.close()
+
+    def summary(self):
+        return {
+            'batches': self.batches,
+            'mean_batch': self.batch_frames / self.batches if self.batches else 0.0,
+            'streams': [stream.summary() for stream in self.streams]
+        }